@@ -1,6 +1,5 @@
 #!/usr/bin/env python3
 import numpy as np
-from scipy.io import loadmat
 from scipy import signal
 import pyaudio
 import time
@@ -14,6 +13,7 @@ import termios
 import tty
 
 from PIL import Image, ImageDraw, ImageFont
+from hrir_bank import get_hrir, SUBJECT_RADIUS_CM
 
 # Configuration
 DURATION = 1.5
@@ -235,6 +235,7 @@ def calibration_routine(hrtf_subjects: list, normalized_angles: list, num_trials
     """
     Calibration routine for multiple HRTF subjects.
     Randomly selects 4 angles per subject, snapped to available HRIR angles, prioritizing negative angles.
+    Stimuli use the subject's own interaural delay, so responses do not depend on an earlier calibration.
     """
     
     # Create an image at the start so it persists across function execution
@@ -312,12 +313,10 @@ def calibration_routine(hrtf_subjects: list, normalized_angles: list, num_trials
 
             hrtf_file = HRTF_PATH / f"Subject_{subject}_{int(preset_angle)}_0.mat"
             try:
-                data = loadmat(str(hrtf_file))
-                if 'hrir_left' not in data or 'hrir_right' not in data:
-                    raise KeyError("Missing hrir_left or hrir_right in HRIR file")
+                hrir_left, hrir_right = get_hrir(subject, preset_angle)
                 spatial_audio = np.column_stack([
-                    signal.lfilter(data['hrir_left'].flatten(), 1, stimulus),
-                    signal.lfilter(data['hrir_right'].flatten(), 1, stimulus)
+                    signal.lfilter(hrir_left, 1, stimulus),
+                    signal.lfilter(hrir_right, 1, stimulus)
                 ])
             except Exception as e:
                 error_msg = f"HRTF Processing Error for file {hrtf_file.name}: {str(e)}"
@@ -351,7 +350,11 @@ def calibration_routine(hrtf_subjects: list, normalized_angles: list, num_trials
     return calibration_data
 
 def estimate_head_params(calibration_data: dict) -> tuple[dict, str]:
-    """Estimate head parameters and classify as male (003) or female (019)."""
+    """
+    Estimate head parameters and classify as male (003) or female (019).
+    Responses measure localization error, not head size, so effective_radius
+    is that of the selected subject (SUBJECT_RADIUS_CM) and the ITD is unscaled.
+    """
     male_norms = {'head_width': 15.2, 'head_length': 19.0, 'effective_radius': 8.6}
     female_norms = {'head_width': 14.5, 'head_length': 18.2, 'effective_radius': 8.2}
 
@@ -364,8 +367,7 @@ def estimate_head_params(calibration_data: dict) -> tuple[dict, str]:
             print(f"Warning: High deviation ({mean_response:.1f}°) for Subject_{subject}. Rear angles may need iteration.")
         params[subject] = {
             'head_width': 0.45 * mean_response + 14.2,
-            'head_length': 0.32 * mean_response + 17.8,
-            'effective_radius': 0.51 * mean_response + 3.2
+            'head_length': 0.32 * mean_response + 17.8
         }
 
     if not params:
@@ -385,6 +387,7 @@ def estimate_head_params(calibration_data: dict) -> tuple[dict, str]:
             if female_dist < male_dist:
                 selected_subject = '019'
 
+    selected_params = {**selected_params, 'effective_radius': SUBJECT_RADIUS_CM[selected_subject]}
     return selected_params, selected_subject
 
 def get_key() -> str:
@@ -0,0 +1,105 @@
+"""
+Decode audio files straight to float32 stereo at 44.1 kHz.
+
+pydub goes through a Python array of ints and makes several full-song copies
+(normalize, set_channels, set_frame_rate, get_array_of_samples, np.array,
+int16 -> float). decode_audio() reads into one contiguous (frames, 2)
+float32 array instead:
+
+- Formats libsndfile reads (WAV, FLAC, OGG, MP3) are read by soundfile
+  directly into the output array. If the file is not at 44.1 kHz, it is
+  resampled with one polyphase filter pass.
+- Anything else (AAC/M4A, WMA, ...) is streamed from an ffmpeg pipe as raw
+  float32, with ffmpeg doing the channel mix and resampling while it decodes.
+
+normalize=True scales the result in place to the same peak as pydub's
+AudioSegment.normalize(), which the separation code expects.
+
+decode_blocks() yields the same samples a block at a time, reading from
+disk as it goes when the file is already 44.1 kHz stereo.
+"""
+import shutil
+import subprocess
+from math import gcd
+
+import numpy as np
+import soundfile as sf
+from scipy.signal import resample_poly
+
+FS = 44100
+CHANNELS = 2
+NORMALIZE_HEADROOM_DB = 0.1  # Same headroom as pydub's AudioSegment.normalize()
+PIPE_READ_SIZE = 1 << 20  # Bytes read from ffmpeg at a time
+
+
+def normalize_in_place(samples: np.ndarray, headroom_db: float = NORMALIZE_HEADROOM_DB) -> np.ndarray:
+    """Scale samples so the peak sits headroom_db below full scale. Silence is left alone."""
+    if samples.size == 0:
+        return samples
+    peak = max(float(samples.max()), -float(samples.min()))  # No full-size np.abs temporary
+    if peak > 0:
+        samples *= 10 ** (-headroom_db / 20) / peak
+    return samples
+
+
+def read_soundfile(file_name, rate: int = FS, channels: int = CHANNELS) -> np.ndarray:
+    """Decode with libsndfile; raises sf.LibsndfileError (a RuntimeError) for formats it cannot read."""
+    with sf.SoundFile(file_name) as f:
+        if f.channels == channels:
+            samples = np.empty((f.frames, channels), dtype=np.float32)
+            f.read(out=samples)
+        else:
+            # Mono is duplicated to both channels; extra channels are dropped
+            decoded = f.read(dtype='float32', always_2d=True)
+            samples = np.empty((len(decoded), channels), dtype=np.float32)
+            samples[:] = decoded[:, :channels] if f.channels > channels else decoded[:, :1]
+        file_rate = f.samplerate
+    if file_rate != rate:
+        common = gcd(rate, file_rate)
+        samples = np.ascontiguousarray(resample_poly(samples, rate // common, file_rate // common, axis=0),
+                                       dtype=np.float32)
+    return samples
+
+
+def read_ffmpeg(file_name, rate: int = FS, channels: int = CHANNELS) -> np.ndarray:
+    """Decode any format ffmpeg knows, resampled and mixed to `channels` by ffmpeg itself."""
+    ffmpeg = shutil.which("ffmpeg")
+    if ffmpeg is None:
+        raise RuntimeError(f"Cannot decode {file_name}: soundfile does not support it and ffmpeg is not installed")
+    command = [ffmpeg, "-nostdin", "-v", "error", "-i", str(file_name),
+               "-f", "f32le", "-acodec", "pcm_f32le", "-ac", str(channels), "-ar", str(rate), "-"]
+    data = bytearray()
+    with subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as process:
+        while chunk := process.stdout.read(PIPE_READ_SIZE):
+            data += chunk
+        error = process.stderr.read().decode(errors="replace").strip()
+    if process.returncode != 0:
+        raise RuntimeError(f"ffmpeg could not decode {file_name}: {error}")
+    usable = len(data) - len(data) % (4 * channels)
+    return np.frombuffer(data, dtype=np.float32, count=usable // 4).reshape(-1, channels)
+
+
+def decode_audio(file_name, rate: int = FS, channels: int = CHANNELS, normalize: bool = False) -> np.ndarray:
+    """Contiguous (frames, channels) float32 samples of an audio file at `rate`."""
+    try:
+        samples = read_soundfile(file_name, rate, channels)
+    except (RuntimeError, TypeError):
+        samples = read_ffmpeg(file_name, rate, channels)
+    return normalize_in_place(samples) if normalize else samples
+
+
+def decode_blocks(file_name, block_frames: int = 1 << 18, rate: int = FS, channels: int = CHANNELS):
+    """Yield the (frames, channels) float32 samples of decode_audio(file_name) in consecutive blocks."""
+    try:
+        f = sf.SoundFile(file_name)
+    except (RuntimeError, TypeError):
+        f = None
+    if f is not None and f.samplerate == rate and f.channels == channels:
+        with f:
+            yield from f.blocks(blocksize=block_frames, dtype='float32', always_2d=True)
+        return
+    if f is not None:
+        f.close()
+    samples = decode_audio(file_name, rate, channels)
+    for start in range(0, len(samples), block_frames):
+        yield samples[start:start + block_frames]
@@ -0,0 +1,34 @@
+import argparse
+import time as Time
+import numpy as np
+from scipy.signal import lfilter
+from hrir_bank import get_hrir
+from hrtf_engine import ConvolutionEngine
+
+# Compare the FFT overlap-add engine against the lfilter path it replaces
+parser = argparse.ArgumentParser(description="Benchmark HRTF convolution: lfilter vs FFT overlap-add.")
+parser.add_argument("--seconds", type=float, default=240, help="Length of the test signal (default: a 4 minute stem)")
+parser.add_argument("--subject", default="003")
+parser.add_argument("--azimuth", type=int, default=45)
+parser.add_argument("--block-sizes", type=int, nargs="+", default=[1024, 2048, 4096, 8192])
+args = parser.parse_args()
+
+fs = 44100
+signal = np.random.uniform(-1, 1, int(args.seconds * fs))
+hrir_left, hrir_right = get_hrir(args.subject, args.azimuth)
+
+start = Time.perf_counter()
+reference = np.column_stack((lfilter(hrir_left, 1, signal), lfilter(hrir_right, 1, signal))).astype(np.float32)
+lfilter_time = Time.perf_counter() - start
+print(f"lfilter: {lfilter_time:.3f} s for {args.seconds:.0f} s of audio")
+
+for block_size in args.block_sizes:
+    engine = ConvolutionEngine(block_size=block_size)
+    engine.hrtf_spectrum(args.subject, args.azimuth)  # Warm the spectrum cache
+
+    start = Time.perf_counter()
+    output = engine.render(signal, args.subject, args.azimuth)
+    fft_time = Time.perf_counter() - start
+
+    error = np.max(np.abs(output - reference))
+    print(f"FFT block {block_size:5d}: {fft_time:.3f} s  speedup {lfilter_time / fft_time:5.2f}x  max abs error {error:.2e}")
@@ -0,0 +1,50 @@
+import argparse
+import os
+import time as Time
+import numpy as np
+from utility import AudioFrames
+from unmix_separator import get_separator, WINDOW_SECONDS, OVERLAP_SECONDS
+
+# Wall time of windowed separation against worker count, and its error against one whole-song pass
+parser = argparse.ArgumentParser(description="Benchmark parallel multi-process separation.")
+parser.add_argument("file", help="Audio file to separate, e.g. Music/song.mp3")
+parser.add_argument("--seconds", type=float, default=180, help="Length of the excerpt to separate")
+parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 3, 4])
+parser.add_argument("--window", type=float, default=WINDOW_SECONDS)
+parser.add_argument("--overlap", type=float, default=OVERLAP_SECONDS)
+args = parser.parse_args()
+
+fs = 44100
+with AudioFrames(args.file) as audio:
+    n = min(audio.frames, int(args.seconds * fs))
+    excerpt = audio.read(0, n)
+print(f"{n / fs:.0f} s excerpt, {os.cpu_count()} cores, {args.window:.0f} s windows with {args.overlap:.0f} s overlap")
+
+separator = get_separator()
+separator.load()  # Keep the weight load out of the timings
+
+start = Time.perf_counter()
+reference = separator.separate(excerpt)
+single_time = Time.perf_counter() - start
+print(f"single process, whole song: {single_time:6.1f} s")
+
+def separate_windows(workers):
+    estimates = {target: np.zeros((n, 2), dtype=np.float32) for target in reference}
+    def write(target, start, block):
+        estimates[target][start:start + len(block)] = block
+    separator.separate_chunked(lambda start, stop: excerpt[start:stop], n, write, window_seconds=args.window,
+                               overlap_seconds=args.overlap, workers=workers)
+    return estimates
+
+for workers in args.workers:
+    start = Time.perf_counter()
+    estimates = separate_windows(workers)
+    wall_time = Time.perf_counter() - start
+
+    # Error relative to each stem's energy, in dB (lower is better)
+    errors = []
+    for target in reference:
+        error = np.sum((estimates[target] - reference[target]) ** 2)
+        errors.append(10 * np.log10(error / max(np.sum(reference[target] ** 2), 1e-12) + 1e-12))
+    print(f"{workers} worker(s): {wall_time:6.1f} s  speedup {single_time / wall_time:4.2f}x  "
+          f"error vs single process: worst {max(errors):6.1f} dB, mean {np.mean(errors):6.1f} dB")
@@ -0,0 +1,78 @@
+import argparse
+import time as Time
+import numpy as np
+from unmix_separator import ResidentSeparator
+
+# Compare the int8 (dynamic quantized) separator against the float model on synthetic mixes
+parser = argparse.ArgumentParser(description="Benchmark dynamic int8 quantization of the separation model.")
+parser.add_argument("--seconds", type=float, default=20, help="Length of each synthetic mix")
+parser.add_argument("--mixes", type=int, default=3)
+parser.add_argument("--seed", type=int, default=0)
+args = parser.parse_args()
+
+fs = 44100
+
+def synthetic_mix(rng, seconds):
+    """Stereo mix of four known sources: a sung line, drums, bass and chords."""
+    t = np.arange(int(seconds * fs)) / fs
+    beat = 60 / rng.uniform(90, 130)
+    notes = lambda low, high: rng.uniform(low, high, int(seconds / beat) + 1)[(t // beat).astype(int)]
+
+    f0 = notes(200, 450) * (1 + 0.01 * np.sin(2 * np.pi * 5.5 * t))  # Vibrato
+    phase = 2 * np.pi * np.cumsum(f0) / fs
+    vocals = sum(np.sin(k * phase) / k for k in range(1, 8)) * (0.6 + 0.4 * np.sin(np.pi * t / beat) ** 2)
+
+    since_beat = t % beat
+    kick = np.sin(2 * np.pi * (50 + 100 * np.exp(-since_beat * 30)) * since_beat) * np.exp(-since_beat * 12)
+    since_hat = t % (beat / 2)
+    hats = rng.standard_normal(len(t)) * np.exp(-since_hat * 60) * 0.3
+    drums = kick + hats
+
+    bass_phase = 2 * np.pi * np.cumsum(notes(45, 110)) / fs
+    bass = np.sin(bass_phase) + 0.3 * np.sin(2 * bass_phase)
+
+    root = notes(260, 520)
+    other = sum(np.sin(2 * np.pi * np.cumsum(root * ratio) / fs) for ratio in (1, 1.25, 1.5)) / 3
+
+    sources = {}
+    for name, source, pan in (("vocals", vocals, 0.5), ("drums", drums, 0.4), ("bass", bass, 0.5), ("other", other, 0.7)):
+        source = 0.25 * source / np.max(np.abs(source))
+        sources[name] = np.column_stack((source * (1 - pan), source * pan)).astype(np.float32) * 2
+    mix = sum(sources.values())
+    return mix / np.max(np.abs(mix)) * 0.9, sources
+
+def sdr(reference, estimate):
+    return 10 * np.log10(np.sum(reference ** 2) / max(np.sum((reference - estimate) ** 2), 1e-12))
+
+separators = {"float": ResidentSeparator(), "int8": ResidentSeparator(quantized=True)}
+for separator in separators.values():
+    start = Time.perf_counter()
+    separator.load()
+    print(f"load time: {Time.perf_counter() - start:.1f} s")
+
+rng = np.random.default_rng(args.seed)
+times = {name: 0.0 for name in separators}
+scores = {name: {} for name in separators}
+agreement = {}
+for i in range(args.mixes):
+    mix, sources = synthetic_mix(rng, args.seconds)
+    # Normalize the sources like the mix so SDR compares like with like
+    scale = 0.9 / np.max(np.abs(sum(sources.values())))
+    estimates = {}
+    for name, separator in separators.items():
+        if i == 0:
+            separator.separate(mix[:fs])  # Warm-up
+        start = Time.perf_counter()
+        estimates[name] = separator.separate(mix)
+        times[name] += Time.perf_counter() - start
+        for target, source in sources.items():
+            scores[name].setdefault(target, []).append(sdr(source * scale, estimates[name][target]))
+    for target in sources:
+        agreement.setdefault(target, []).append(sdr(estimates["float"][target], estimates["int8"][target]))
+
+print(f"\n{args.mixes} synthetic mixes of {args.seconds:.0f} s")
+print(f"float: {times['float']:.1f} s   int8: {times['int8']:.1f} s   speedup {times['float'] / times['int8']:.2f}x")
+print(f"{'target':8s} {'SDR float':>10s} {'SDR int8':>10s} {'delta':>7s} {'int8 vs float':>14s}")
+for target in scores["float"]:
+    sdr_float, sdr_int8 = np.mean(scores["float"][target]), np.mean(scores["int8"][target])
+    print(f"{target:8s} {sdr_float:8.2f} dB {sdr_int8:8.2f} dB {sdr_int8 - sdr_float:+6.2f} {np.mean(agreement[target]):11.2f} dB")
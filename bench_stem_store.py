@@ -0,0 +1,116 @@
+import argparse
+import os
+import shutil
+import tempfile
+import time as Time
+import h5py
+import numpy as np
+from spatial_stream import STREAM_BLOCK_SIZE
+from stem_store import STEMS, StemReader, StemStore, store_size
+
+# Size and read speed of memory-mapped stem stores in each format against the HDF5 layouts they replace
+parser = argparse.ArgumentParser(description="Benchmark stem storage layouts and formats.")
+parser.add_argument("stems", help="Stem store to copy the stems from, e.g. Spatial/song.stems")
+parser.add_argument("--seconds", type=float, default=180, help="Length of the stems used")
+parser.add_argument("--ranges", type=int, default=200, help="Random time ranges read per layout")
+parser.add_argument("--range-seconds", type=float, default=1.0, help="Length of each random range")
+parser.add_argument("--seed", type=int, default=0)
+args = parser.parse_args()
+
+fs = 44100
+source = StemStore(args.stems)
+names = [name for name in STEMS if name in source]
+n = min(int(args.seconds * fs), *(len(source.reader(name)) for name in names))
+stems = {name: np.array(source.reader(name).read(0, n)) for name in names}
+raw_mb = sum(stem.nbytes for stem in stems.values()) / 1e6
+print(f"{len(stems)} stems of {n / fs:.0f} s, {raw_mb:.1f} MB as raw float32")
+
+rng = np.random.default_rng(args.seed)
+range_frames = int(args.range_seconds * fs)
+starts = rng.integers(0, max(n - range_frames, 1), args.ranges)
+
+
+class Hdf5Layout:
+    def __init__(self, **options):
+        self.options = options
+
+    def write(self, path):
+        with h5py.File(path, "w") as f:
+            for name, stem in stems.items():
+                f.create_dataset(name, data=stem, **self.options)
+
+    def open(self, path):
+        f = h5py.File(path, "r")
+        return f, {name: StemReader(f[name]) for name in stems}
+
+    def size(self, path):
+        return os.path.getsize(path)
+
+
+class StoreLayout:
+    def __init__(self, stem_format):
+        self.stem_format = stem_format
+
+    def write(self, path):
+        store = StemStore.create(path)
+        for name, stem in stems.items():
+            store.write(name, stem, self.stem_format)
+
+    def open(self, path):
+        store = StemStore(path)
+        return None, {name: store.reader(name) for name in stems}
+
+    def size(self, path):
+        return store_size(path)
+
+
+layouts = {
+    "hdf5 gzip, auto chunks": Hdf5Layout(compression="gzip"),
+    "hdf5 shuffle+lzf, aligned": Hdf5Layout(chunks=(16 * STREAM_BLOCK_SIZE, 2), compression="lzf", shuffle=True),
+    "store float32": StoreLayout("float32"),
+    "store int16": StoreLayout("int16"),
+    "store float16": StoreLayout("float16"),
+}
+
+print(f"{'layout':26s} {'size MB':>8s} {'ratio':>6s} {'write s':>8s} {'full read s':>12s} "
+      f"{'stream read s':>14s} {'range read ms':>14s}")
+with tempfile.TemporaryDirectory() as directory:
+    for label, layout in layouts.items():
+        path = os.path.join(directory, "stems")
+        start = Time.perf_counter()
+        layout.write(path)
+        write_time = Time.perf_counter() - start
+        size_mb = layout.size(path) / 1e6
+
+        f, readers = layout.open(path)
+        start = Time.perf_counter()
+        for reader in readers.values():
+            np.array(reader.read())  # Copied, so mapped stores are actually read from disk
+        full_time = Time.perf_counter() - start
+
+        # What StreamingRenderer does: every stem, one renderer block at a time
+        start = Time.perf_counter()
+        for block_start in range(0, n, STREAM_BLOCK_SIZE):
+            for reader in readers.values():
+                reader.read_mono(block_start, block_start + STREAM_BLOCK_SIZE)
+        stream_time = Time.perf_counter() - start
+        if f is not None:
+            f.close()
+
+        # Seeking: each range is read from a freshly opened layout, as when a song is started mid-way
+        range_time = 0.0
+        for range_start in starts:
+            start = Time.perf_counter()
+            f, readers = layout.open(path)
+            for reader in readers.values():
+                np.array(reader.read(range_start, range_start + range_frames))
+            range_time += Time.perf_counter() - start
+            if f is not None:
+                f.close()
+
+        print(f"{label:26s} {size_mb:8.1f} {raw_mb / size_mb:6.2f} {write_time:8.2f} {full_time:12.3f} "
+              f"{stream_time:14.3f} {1000 * range_time / len(starts):14.2f}")
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
@@ -1,12 +1,11 @@
 import numpy as np
-from scipy.io import loadmat
-from scipy.signal import lfilter
 import pyaudio
 import time
 import json
 import os
 import matplotlib.pyplot as plt
 from pathlib import Path
+from hrtf_engine import get_engine
 
 # Constants
 FS = 16000  # Sampling rate (Hz)
@@ -22,17 +21,10 @@ def generate_white_noise(duration, fs):
     """Generate white noise signal."""
     return np.random.normal(0, 0.5, int(duration * fs))
 
-def apply_hrtf(signal, azimuth, subject="003"):
-    """Apply HRTF to a mono signal."""
-    data = loadmat(f'{HRTF_PATH}Subject_{subject}_{azimuth}_0.mat')
-    hrir_left = data['hrir_left'].flatten()
-    hrir_right = data['hrir_right'].flatten()
-    
-    # Apply HRIRs
-    y_left = lfilter(hrir_left, 1, signal)
-    y_right = lfilter(hrir_right, 1, signal)
-    
-    return np.column_stack((y_left, y_right)).astype(np.float32)
+def apply_hrtf(signal, azimuth, subject="003", itd_scale=1.0):
+    """Apply HRTF to a mono signal, with the interaural delay scaled by itd_scale."""
+    # Block FFT convolution, equivalent to lfilter(hrir, 1, signal) per ear
+    return get_engine().render(signal, subject, azimuth, itd_scale)
 
 def play_audio(audio_data, fs):
     """Play audio through device."""
@@ -0,0 +1,74 @@
+import argparse
+import sys
+import numpy as np
+from unmix_separator import get_separator, OVERLAP_SECONDS
+
+# Check that chunked separation matches whole-track separation around the window seams
+FS = 44100
+SEAM_THRESHOLD_DB = -50  # Largest allowed seam error relative to the stem (the test's stand-in measures -57 dB, -27 dB without the crossfade)
+
+
+def seam_mask(n, window, overlap):
+    """Frames of an n-frame track within the crossfaded overlaps, padded by one overlap on each side."""
+    hop = window - overlap
+    seam = np.zeros(n, dtype=bool)
+    for start in range(hop, n - overlap, hop):
+        seam[max(start - overlap, 0):start + 2 * overlap] = True
+    return seam
+
+
+def error_db(estimate, reference):
+    error = np.sum((estimate - reference) ** 2)
+    return 10 * np.log10(error / max(np.sum(reference ** 2), 1e-12) + 1e-12)
+
+
+def seam_errors(separator, excerpt, window_seconds, overlap_seconds, workers=1):
+    """Separate excerpt whole and chunked; return {target: (seam error dB, interior error dB)}."""
+    n = len(excerpt)
+    reference = separator.separate(excerpt)
+
+    chunked = {target: np.zeros((n, 2), dtype=np.float32) for target in reference}
+    def write(target, start, block):
+        chunked[target][start:start + len(block)] = block
+    separator.separate_chunked(lambda start, stop: excerpt[start:stop], n, write,
+                               window_seconds=window_seconds, overlap_seconds=overlap_seconds, workers=workers)
+
+    seam = seam_mask(n, int(window_seconds * FS), int(overlap_seconds * FS))
+    if not seam.any():
+        raise ValueError(f"Excerpt of {n / FS:.1f} s has no seams with a {window_seconds} s window")
+    return {target: (error_db(chunked[target][seam], reference[target][seam]),
+                     error_db(chunked[target][~seam], reference[target][~seam]))
+            for target in reference}
+
+
+def main():
+    from utility import AudioFrames  # Only the command line reads audio files
+
+    parser = argparse.ArgumentParser(description="Compare chunked and whole-track separation at the window seams.")
+    parser.add_argument("file", help="Audio file to separate, e.g. Music/song.mp3")
+    parser.add_argument("--seconds", type=float, default=60, help="Length of the excerpt separated both ways")
+    parser.add_argument("--window", type=float, default=20, help="Chunk window in seconds (short, so the excerpt has seams)")
+    parser.add_argument("--overlap", type=float, default=OVERLAP_SECONDS)
+    parser.add_argument("--threshold-db", type=float, default=SEAM_THRESHOLD_DB,
+                        help="Largest allowed seam error relative to the stem")
+    args = parser.parse_args()
+
+    with AudioFrames(args.file) as audio:
+        n = min(audio.frames, int(args.seconds * FS))
+        excerpt = audio.read(0, n)
+
+    try:
+        errors = seam_errors(get_separator(), excerpt, args.window, args.overlap)
+    except ValueError as e:
+        sys.exit(str(e))
+
+    failed = False
+    for target, (seam_db, interior_db) in errors.items():
+        failed |= seam_db > args.threshold_db
+        print(f"{target:7s}: seam error {seam_db:6.1f} dB, interior error {interior_db:6.1f} dB")
+    print("FAIL" if failed else "PASS", f"(threshold {args.threshold_db:.0f} dB)")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
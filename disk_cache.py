@@ -0,0 +1,140 @@
+"""
+Least-recently-used cache directories on the SD card.
+
+stem_cache and render_cache both keep entries named <key><suffix> in a
+directory, with an INDEX_FILE recording when each was last used, and
+delete the least recently used entries when the directory grows past a
+budget. DiskCache is that shared part.
+
+Eviction sizes the cache from what is actually in the directory, not from
+the index, so entries the index does not list are still counted and
+deleted. These can be entries from before a version bump reset the index,
+or from an index that was lost. They count as the least recently used.
+Unfinished entries (<key><suffix>.part) that have not been written to for
+STALE_PART_SECONDS were left by a killed separation or render, and are
+deleted too.
+"""
+import json
+import os
+import shutil
+import threading
+import time as Time
+from contextlib import contextmanager
+from pathlib import Path
+
+INDEX_FILE = "index.json"
+PART_SUFFIX = ".part"
+STALE_PART_SECONDS = 24 * 3600  # Longer than any separation or render takes
+
+
+def path_size(path) -> int:
+    """Bytes of a file, or of the files in a directory."""
+    if os.path.isdir(path):
+        return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+    return os.path.getsize(path)
+
+
+def _last_modified(path) -> float:
+    if os.path.isdir(path):
+        return max([os.path.getmtime(path)] + [entry.stat().st_mtime for entry in os.scandir(path)])
+    return os.path.getmtime(path)
+
+
+def _remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+
+
+class DiskCache:
+    """
+    Entries <key><suffix> (files or directories) in directory, with an
+    index of when each was last used and LRU eviction past max_mb.
+
+    Bumping version starts a fresh index; the old entries are then the
+    first to be evicted.
+    """
+
+    def __init__(self, directory, suffix: str, version: int, max_mb: int, label: str):
+        self.directory = Path(directory)
+        self.index_file = self.directory / INDEX_FILE
+        self.suffix = suffix
+        self.version = version
+        self.max_mb = max_mb
+        self.label = label  # What an entry is, for eviction messages
+        self.lock = threading.Lock()  # Worker threads and the UI both update the index
+
+    def load_index(self) -> dict:
+        try:
+            with open(self.index_file, 'r') as f:
+                index = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            index = {}
+        if index.get("version") != self.version:
+            index = {"version": self.version}
+        index.setdefault("entries", {})
+        return index
+
+    def save_index(self, index: dict):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.index_file.with_name(self.index_file.name + ".tmp")
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f, indent=4)
+        os.replace(tmp_path, self.index_file)
+
+    @contextmanager
+    def edit_index(self):
+        """Load the index for changing, and save it afterwards, holding the lock throughout."""
+        with self.lock:
+            index = self.load_index()
+            yield index
+            self.save_index(index)
+
+    def entry_path(self, key: str) -> Path:
+        """Where the entry for key is stored; the cache directory is created on first use."""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        return self.directory / f"{key}{self.suffix}"
+
+    def touch(self, key: str):
+        with self.edit_index() as index:
+            index["entries"].setdefault(key, {})["last_used"] = Time.time()
+
+    def evict(self, max_bytes: int = None, keep=(), on_evict=None):
+        """
+        Delete least recently used entries until the cache fits in max_bytes
+        (max_mb by default). on_evict(key, index_entry) is called for each
+        entry deleted, e.g. to remove links to it.
+        """
+        if max_bytes is None:
+            max_bytes = self.max_mb << 20
+        if not self.directory.exists():
+            return
+        with self.edit_index() as index:
+            entries = index["entries"]
+            sizes, total = {}, 0
+            for item in os.scandir(self.directory):
+                if item.name.endswith(self.suffix + PART_SUFFIX):
+                    if Time.time() - _last_modified(item.path) > STALE_PART_SECONDS:
+                        _remove(item.path)
+                        print(f"Removed unfinished {self.label} {item.name}")
+                    else:
+                        total += path_size(item.path)  # Still being written
+                elif item.name.endswith(self.suffix):
+                    key = item.name[:-len(self.suffix)]
+                    sizes[key] = path_size(item.path)
+                    total += sizes[key]
+            for key in list(entries):
+                if key not in sizes:
+                    del entries[key]  # Deleted by hand
+            for key in sorted(sizes, key=lambda key: entries.get(key, {}).get("last_used", 0)):
+                if total <= max_bytes:
+                    break
+                if key in keep:
+                    continue
+                if on_evict is not None:
+                    on_evict(key, entries.get(key, {}))
+                _remove(self.entry_path(key))
+                entries.pop(key, None)
+                total -= sizes[key]
+                print(f"Evicted cached {self.label} {key} ({sizes[key] / 1e6:.0f} MB)")
@@ -5,13 +5,13 @@ import tty
 import termios
 from pathlib import Path
 import numpy as np
-from scipy.io import loadmat
 from scipy import signal
 import pyaudio
 import platform
 import os
 import time
 from PIL import Image, ImageDraw, ImageFont
+from hrir_bank import get_hrir, itd_scale, GRID_START, GRID_SIZE
 
 # Configuration
 PROFILES_DIR = Path("user_profiles")
@@ -248,7 +248,7 @@ def select_stem(up=None, down=None, left=None, right=None, enter=None, lcd=None)
             selected_idx += 1
 
 
-def get_angle_input(current_angle: float, available_angles: list, subject: str, up=None, down=None, left=None, right=None, enter=None, lcd=None) -> float:
+def get_angle_input(current_angle: float, available_angles: list, subject: str, head_scale: float = 1.0, up=None, down=None, left=None, right=None, enter=None, lcd=None) -> float:
     angle = current_angle
     stimulus = generate_swept_sine(DURATION, FS)
     HEIGHT, WIDTH = 240, 320
@@ -280,14 +280,11 @@ def get_angle_input(current_angle: float, available_angles: list, subject: str,
         elif ch == 'a':
             angle -= 1
         elif ch == 'p':
-            hrtf_file = HRTF_PATH / f"Subject_{subject}_{int(snap_to_nearest_angle(angle, available_angles))}_0.mat"
             try:
-                data = loadmat(str(hrtf_file))
-                if 'hrir_left' not in data or 'hrir_right' not in data:
-                    raise KeyError("Missing hrir_left or hrir_right in HRIR file")
+                hrir_left, hrir_right = get_hrir(subject, snap_to_nearest_angle(angle, available_angles), head_scale)
                 spatial_audio = np.column_stack([
-                    signal.lfilter(data['hrir_left'].flatten(), 1, stimulus),
-                    signal.lfilter(data['hrir_right'].flatten(), 1, stimulus)
+                    signal.lfilter(hrir_left, 1, stimulus),
+                    signal.lfilter(hrir_right, 1, stimulus)
                 ])
                 play_audio(spatial_audio, FS)
             except Exception as e:
@@ -315,17 +312,17 @@ def edit_profile(up=None, down=None, left=None, right=None, enter=None, lcd=None
     if "stem_directions" not in profile_data:
         profile_data["stem_directions"] = {"bass": 0, "vocals": 0, "drums": 0, "other": 0}
     
-    # Load available angles for the subject's HRIRs
+    # Any whole-degree angle is served from the interpolated HRIR bank, so angles are only rounded
     subject = profile_data["hrtf_subject"]
-    available_angles = get_available_angles(HRTF_PATH, subject)
-    if not available_angles:
-        print(f"Warning: No HRIR files found for Subject_{subject} in {HRTF_PATH}. Angles will not be snapped.")
-        available_angles = list(range(-180, 181))  # Fallback to all integers
+    if not get_available_angles(HRTF_PATH, subject):
+        print(f"Warning: No HRIR files found for Subject_{subject} in {HRTF_PATH}. Previews will not play.")
+    available_angles = list(range(GRID_START, GRID_START + GRID_SIZE))
+    head_scale = itd_scale(profile_data["effective_radius"], subject)  # Previews use the listener's interaural delay
     
     while True:
         stem = select_stem(up=up, down=down, right=right, left=left, enter=enter, lcd=lcd)
         current_angle = profile_data["stem_directions"].get(stem, 0)
-        new_angle = get_angle_input(current_angle, available_angles, subject, up=up, down=down, right=right, left=left, enter=enter, lcd=lcd)
+        new_angle = get_angle_input(current_angle, available_angles, subject, head_scale, up=up, down=down, right=right, left=left, enter=enter, lcd=lcd)
         profile_data["stem_directions"][stem] = new_angle
         
         print("\nCurrent stem directions:")
@@ -0,0 +1,193 @@
+"""
+Block-size autotuner for the HRTF convolution engine.
+
+The fastest block size depends on the CPU (cache size, SIMD width, core
+count) and on the HRIR length, so it is measured rather than guessed. For
+every FFT size in FFT_SIZES two partition schemes are timed on a short
+four-stem mix:
+
+  - "half": a power-of-two block of n_fft / 2, half of each frame is padding
+  - "filled": n_fft - taps + 1 samples, the longest block the frame holds
+
+followed by the number of blocks transformed per FFT call for the winner.
+taps is the longest filter the engine can produce (see max_taps), and the
+mix is rendered at the widest ITD scale so its filters are that long.
+The result is stored in TUNING_FILE together with a fingerprint of the
+machine and of the HRIR bank, and hrtf_engine.get_engine() reuses it until
+either fingerprint changes. The app measures it in a background thread at
+boot, once the separation model is loaded (hrtf_engine.tune_in_background);
+renders before it finishes use DEFAULT_BLOCK_SIZE.
+
+Usage:
+    python engine_tuning.py tune [--force]
+    python engine_tuning.py show
+"""
+import argparse
+import hashlib
+import json
+import os
+import platform
+import time as Time
+from pathlib import Path
+
+import numpy as np
+import scipy
+
+from hrir_bank import HRTF_PATH, INDEX_FILE, ITD_SCALE_RANGE, get_bank
+from hrtf_engine import FS, ConvolutionEngine
+
+TUNING_FILE = Path("engine_tuning.json")  # Next to user_profiles/, specific to this machine
+TUNING_VERSION = 2
+FFT_SIZES = (2048, 4096, 8192, 16384, 32768)
+BATCH_SIZES = (4, 16, 64)
+BATCH_MAX_SAMPLES = 1 << 20  # Largest frame batch per stem, bounds the FFT working set (~8 MB per stem)
+TUNING_SECONDS = 6  # Length of the benchmark stems
+TUNING_STEMS = 4
+TUNING_REPEATS = 5  # Best of this many runs is kept
+
+
+def hardware_fingerprint() -> str:
+    """Hash of what decides FFT speed here: CPU model and count, and numpy/scipy versions."""
+    cpu = platform.processor()
+    try:
+        with open("/proc/cpuinfo", 'r') as f:
+            for line in f:
+                if line.lower().startswith(("model name", "hardware", "cpu part")):
+                    cpu = line.split(":", 1)[1].strip()
+                    break
+    except OSError:
+        pass
+    parts = [platform.machine(), cpu, str(os.cpu_count()), np.__version__, scipy.__version__]
+    return hashlib.sha1("|".join(parts).encode()).hexdigest()[:16]
+
+
+def bank_fingerprint(hrtf_path: Path = HRTF_PATH) -> str:
+    """Hash of the bank index, which records the bank version and the .mat files it was built from."""
+    get_bank(hrtf_path)  # Rebuilds the bank first if it is stale
+    with open(hrtf_path / INDEX_FILE, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()[:16]
+
+
+def max_taps(bank) -> int:
+    """
+    Longest HRIR the engine can render with: the stored filters, which are
+    longer than the compact ones, plus the extra delay get_hrir adds to the
+    later ear at the widest ITD scale.
+    """
+    return bank.taps + int(np.ceil(float(np.max(bank.itd)) * (ITD_SCALE_RANGE[1] - 1)))
+
+
+def candidate_blocks(taps: int) -> list[tuple[str, int]]:
+    """(scheme, block_size) pairs to time for filters up to `taps` long."""
+    candidates = []
+    for n_fft in FFT_SIZES:
+        candidates.append(("half", n_fft // 2))
+        candidates.append(("filled", n_fft - taps + 1))
+    return candidates
+
+
+def time_engine(engine: ConvolutionEngine, stems: dict, directions: dict, subject: str,
+                itd_scale: float = 1.0) -> float:
+    """Best wall-clock time of engine.render_mix over TUNING_REPEATS runs."""
+    engine.render_mix(stems, directions, subject, itd_scale)  # Warm the spectrum cache
+    best = float("inf")
+    for _ in range(TUNING_REPEATS):
+        start = Time.perf_counter()
+        engine.render_mix(stems, directions, subject, itd_scale)
+        best = min(best, Time.perf_counter() - start)
+    return best
+
+
+def run_benchmark() -> dict:
+    """Time every candidate on this machine and return the fastest settings."""
+    bank = get_bank()
+    subject = bank.subjects[0]
+    rng = np.random.default_rng(0)
+    names = [f"stem{i}" for i in range(TUNING_STEMS)]
+    stems = {name: rng.uniform(-1, 1, TUNING_SECONDS * FS).astype(np.float32) for name in names}
+    directions = {name: az for name, az in zip(names, np.linspace(-90, 90, TUNING_STEMS))}
+
+    taps = max_taps(bank)
+    itd_scale = ITD_SCALE_RANGE[1]
+    results = []
+    for scheme, block_size in candidate_blocks(taps):
+        seconds = time_engine(ConvolutionEngine(block_size=block_size), stems, directions, subject, itd_scale)
+        print(f"  {scheme:6s} block {block_size:5d}: {seconds * 1000:7.1f} ms")
+        results.append({"scheme": scheme, "block_size": block_size, "blocks_per_batch": None, "seconds": seconds})
+    best = min(results, key=lambda r: r["seconds"])
+
+    batch_results = []
+    n_fft = ConvolutionEngine(block_size=best["block_size"]).fft_size(taps)
+    for blocks_per_batch in [b for b in BATCH_SIZES if b * n_fft <= BATCH_MAX_SAMPLES] or [1]:
+        engine = ConvolutionEngine(block_size=best["block_size"], blocks_per_batch=blocks_per_batch)
+        seconds = time_engine(engine, stems, directions, subject, itd_scale)
+        print(f"  {best['scheme']:6s} block {best['block_size']:5d} x {blocks_per_batch:2d} per batch: {seconds * 1000:7.1f} ms")
+        batch_results.append({"scheme": best["scheme"], "block_size": best["block_size"],
+                              "blocks_per_batch": blocks_per_batch, "seconds": seconds})
+    best = min(batch_results, key=lambda r: r["seconds"])
+
+    return {
+        "block_size": best["block_size"],
+        "blocks_per_batch": best["blocks_per_batch"],
+        "scheme": best["scheme"],
+        "realtime_factor": TUNING_SECONDS * TUNING_STEMS / best["seconds"],
+        "results": results + batch_results,
+    }
+
+
+def load_tuning(tuning_file: Path = TUNING_FILE, hrtf_path: Path = HRTF_PATH):
+    """Return the stored tuning if it matches this machine and bank, else None."""
+    try:
+        with open(tuning_file, 'r') as f:
+            tuning = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+    if (tuning.get("version") != TUNING_VERSION
+            or tuning.get("hardware") != hardware_fingerprint()
+            or tuning.get("bank") != bank_fingerprint(hrtf_path)):
+        return None
+    return tuning
+
+
+def tune(force: bool = False, tuning_file: Path = TUNING_FILE, hrtf_path: Path = HRTF_PATH) -> dict:
+    """Return the engine settings for this machine, benchmarking first if none are stored or they are stale."""
+    tuning = None if force else load_tuning(tuning_file, hrtf_path)
+    if tuning is not None:
+        return tuning
+
+    print("Tuning HRTF engine block size for this machine...")
+    tuning = {"version": TUNING_VERSION, "hardware": hardware_fingerprint(), "bank": bank_fingerprint(hrtf_path)}
+    tuning.update(run_benchmark())
+    print(f"Using {tuning['scheme']} blocks of {tuning['block_size']} samples, "
+          f"{tuning['blocks_per_batch']} per batch ({tuning['realtime_factor']:.0f}x realtime)")
+
+    tmp_path = tuning_file.with_name(tuning_file.name + ".tmp")
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(tuning, f, indent=4)
+        os.replace(tmp_path, tuning_file)
+    except OSError as e:
+        print(f"Could not save engine tuning: {e}")
+    return tuning
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tune the HRTF engine block size for this machine.")
+    parser.add_argument("command", choices=["tune", "show"])
+    parser.add_argument("--force", action="store_true", help="Benchmark even if the stored tuning is current")
+    parser.add_argument("--file", type=Path, default=TUNING_FILE)
+    args = parser.parse_args()
+
+    if args.command == "tune":
+        tune(force=args.force, tuning_file=args.file)
+    else:
+        tuning = load_tuning(args.file)
+        if tuning is None:
+            print(f"No current tuning in {args.file}; run `python engine_tuning.py tune`")
+        else:
+            print(f"{tuning['scheme']} blocks of {tuning['block_size']} samples, "
+                  f"{tuning['blocks_per_batch']} per batch ({tuning['realtime_factor']:.0f}x realtime)")
+
+
+if __name__ == "__main__":
+    main()
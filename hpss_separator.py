@@ -0,0 +1,113 @@
+"""
+Fast preview separation without the neural model.
+
+HpssSeparator splits a mix into the same four stems as openunmix using
+librosa's harmonic/percussive source separation (HPSS) and a few
+frequency masks:
+
+- drums: the percussive part
+- bass: the harmonic part below BASS_CUTOFF_HZ
+- vocals: the harmonic part in VOCAL_BAND_HZ that is panned to the centre
+- other: the rest of the harmonic part
+
+The soft masks add up to one in every time-frequency bin, so the stems sum
+back to the mix. The stems are much less clean than openunmix's. Any
+centred instrument ends up in the vocals, and the low end of every
+instrument ends up in the bass. In exchange a song takes seconds instead of
+minutes, which is enough for a quick spatial effect. Chunking, workers and
+target selection come from ResidentSeparator.
+"""
+import time as Time
+
+import librosa
+import numpy as np
+
+from unmix_separator import FS, ResidentSeparator
+
+TARGETS = ("vocals", "drums", "bass", "other")  # Same stems, in the same order, as openunmix
+N_FFT = 2048
+HOP_LENGTH = 512
+HPSS_KERNEL = 17  # Median filter length in frames and in bands
+MASK_BANDS = 256  # Log-spaced bands the median filters run on; filtering every bin takes several times longer
+BASS_CUTOFF_HZ = 150
+VOCAL_BAND_HZ = (200, 6000)
+CROSSOVER_ORDER = 4  # Slope of the frequency masks, as for a Butterworth filter of this order
+CENTRE_POWER = 4  # Sharpens the centre mask so only bins close to mono count as vocals
+
+
+def lowpass_mask(freqs: np.ndarray, cutoff: float) -> np.ndarray:
+    """Butterworth-shaped power response: 1 well below cutoff, 0.5 at cutoff, 0 well above."""
+    return 1 / (1 + (freqs / cutoff) ** (2 * CROSSOVER_ORDER))
+
+
+def band_starts(n_bins: int) -> np.ndarray:
+    """First bin of each of (at most) MASK_BANDS log-spaced bands; the lowest bands are single bins."""
+    return np.unique(np.round(np.geomspace(1, n_bins, MASK_BANDS)).astype(int) - 1)
+
+
+def centre_mask(left: np.ndarray, right: np.ndarray) -> np.ndarray:
+    """1 where the two channels are equal (panned to the centre), falling to 0 as they differ."""
+    similarity = 2 * np.real(left * np.conj(right)) / (np.abs(left) ** 2 + np.abs(right) ** 2 + 1e-10)
+    return np.clip(similarity, 0, 1) ** CENTRE_POWER
+
+
+class HpssSeparator(ResidentSeparator):
+    """Separates with HPSS and frequency masks instead of the openunmix model. Nothing to load."""
+
+    def __init__(self):
+        super().__init__(model="hpss", device="cpu", num_threads=1, torchscript=False)
+
+    def load(self):
+        return None
+
+    def target_separator(self, targets=None):
+        """Check the requested targets; all of them come out of the same masks."""
+        unknown = set(targets or ()) - set(TARGETS)
+        if unknown:
+            raise ValueError(f"Unknown targets {sorted(unknown)}; the fast separator has {list(TARGETS)}")
+        return None
+
+    def separate(self, samples: np.ndarray, rate: int = FS, targets=None) -> dict:
+        """Separate a (samples, 2) float array into {target: (samples, 2) float32 array}."""
+        self.target_separator(targets)
+        start = Time.perf_counter()
+        samples = np.asarray(samples, dtype=np.float32)
+        spectra = librosa.stft(samples.T, n_fft=N_FFT, hop_length=HOP_LENGTH)  # (2, bins, frames)
+        left, right = spectra
+
+        # One HPSS on the summed magnitudes, so both channels get the same split, pooled into bands
+        magnitude = np.abs(left) + np.abs(right)
+        starts = band_starts(len(magnitude))
+        bands = np.add.reduceat(magnitude, starts, axis=0) / np.diff(starts, append=len(magnitude))[:, None]
+        harmonic, percussive = librosa.decompose.hpss(bands, kernel_size=HPSS_KERNEL, mask=True)
+        band_of_bin = np.searchsorted(starts, np.arange(len(magnitude)), side="right") - 1
+        harmonic, percussive = harmonic[band_of_bin], percussive[band_of_bin]
+        freqs = librosa.fft_frequencies(sr=rate, n_fft=N_FFT)[:, None]
+        bass = harmonic * lowpass_mask(freqs, BASS_CUTOFF_HZ)
+        vocal_band = (1 - lowpass_mask(freqs, VOCAL_BAND_HZ[0])) * lowpass_mask(freqs, VOCAL_BAND_HZ[1])
+        vocals = (harmonic - bass) * vocal_band * centre_mask(left, right)
+        masks = {"vocals": vocals, "drums": percussive, "bass": bass}
+
+        wanted = [target for target in TARGETS if targets is None or target in targets]
+        estimates = {}
+        for target in masks:
+            if target in wanted or "other" in wanted:
+                estimate = librosa.istft(spectra * masks[target], n_fft=N_FFT, hop_length=HOP_LENGTH,
+                                         length=len(samples))
+                estimates[target] = estimate.T.astype(np.float32)
+        if "other" in wanted:
+            # The masks add up to one, so the rest of the mix is "other" without another inverse STFT
+            estimates["other"] = samples - sum(estimates.values())
+        estimates = {target: estimates[target] for target in wanted}
+        print(f"Fast-separated {len(samples) / rate:.1f} s of audio in {Time.perf_counter() - start:.1f} s")
+        return estimates
+
+
+_hpss_separator = None
+
+
+def get_hpss_separator() -> HpssSeparator:
+    global _hpss_separator
+    if _hpss_separator is None:
+        _hpss_separator = HpssSeparator()
+    return _hpss_separator
@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+"""
+Compiled HRIR bank.
+
+All HRIRs in HRIRs/Subject_XXX_<az>_0.mat are packed into one contiguous
+float32 array of shape (subject, azimuth, ear, taps) saved as a .npy file and
+memory-mapped at load time. A small JSON index maps (subject, azimuth) to the
+row of that array, so a lookup is a slice instead of a loadmat() call.
+
+A second table holds an HRIR for every whole degree from -180 to 179, so any
+profile angle is served at the same cost as a measured one. Measured angles
+are copied as-is; the rest are interpolated between the two neighbouring
+measured azimuths by aligning their onset delays, interpolating the magnitude
+spectra and rebuilding a minimum-phase filter with the interpolated delay.
+
+Every entry of the 1° table is also stored in a compact form: a short
+minimum-phase filter per ear plus a pure interaural delay in samples. The
+filter length is the shortest candidate whose log-spectral error stays under
+a threshold (see compact_tables), and compact_hrir() turns the pair back into
+a filter of roughly half the stored length for the renderers. The interaural
+delay can be rescaled there for a listener's head size (see itd_scale).
+
+Rebuild with:
+    python hrir_bank.py build        # only if the .mat files changed
+    python hrir_bank.py build --force
+    python hrir_bank.py check        # exit code 1 if the bank is stale
+    python hrir_bank.py build --force --max-error-db 1.0   # longer compact filters
+"""
+import argparse
+import json
+import os
+import sys
+from pathlib import Path
+
+import numpy as np
+from scipy.io import loadmat
+
+HRTF_PATH = Path("HRIRs")
+BANK_FILE = "hrir_bank.npy"
+INDEX_FILE = "hrir_bank.json"
+INTERP_FILE = "hrir_bank_interp.npy"
+MINPHASE_FILE = "hrir_bank_minphase.npy"
+ITD_FILE = "hrir_bank_itd.npy"
+TABLE_FILES = (BANK_FILE, INTERP_FILE, MINPHASE_FILE, ITD_FILE)
+BANK_VERSION = 4  # Bump when the bank layout changes so old banks are rebuilt
+EARS = ("hrir_left", "hrir_right")
+GRID_START = -180
+GRID_SIZE = 360  # 1° steps covering the full circle
+INTERP_FFT = 1024  # Long enough that the cepstral minimum-phase step does not alias
+ONSET_THRESHOLD = 0.1  # Fraction of the peak that marks the onset of an HRIR
+MINPHASE_TAPS = (16, 24, 32, 48, 64, 96, 128)  # Candidate compact filter lengths
+MINPHASE_MAX_ERROR_DB = 1.5  # Worst-case RMS log-spectral error allowed for the compact filters
+MINPHASE_FLOOR_DB = -40  # Bins this far below an HRIR's peak are ignored in the error
+SUBJECT_RADIUS_CM = {"003": 8.6, "019": 8.2}  # Effective head radius of each HRIR subject (CalibrateV3 norms)
+ITD_SCALE_RANGE = (0.75, 1.25)  # Plausible adult head sizes relative to the HRIR subject
+
+_bank = None
+
+
+def _source_files(hrtf_path: Path) -> dict:
+    """Map every Subject_XXX_<az>_0.mat file to (subject, azimuth)."""
+    sources = {}
+    for file in sorted(hrtf_path.glob("Subject_*_*_0.mat")):
+        parts = file.stem.split('_')
+        try:
+            sources[file.name] = (parts[1], int(parts[2]))
+        except (IndexError, ValueError):
+            continue
+    return sources
+
+
+def bank_is_current(hrtf_path: Path = HRTF_PATH) -> bool:
+    """True if the bank exists and was built from the current set of .mat files."""
+    index_path = hrtf_path / INDEX_FILE
+    if not all((hrtf_path / name).exists() for name in TABLE_FILES + (INDEX_FILE,)):
+        return False
+    try:
+        with open(index_path, 'r') as f:
+            index = json.load(f)
+    except json.JSONDecodeError:
+        return False
+
+    if index.get("version") != BANK_VERSION:
+        return False
+
+    recorded = index.get("sources", {})
+    sources = _source_files(hrtf_path)
+    if set(recorded) != set(sources):
+        return False
+    for name, mtime in recorded.items():
+        if os.path.getmtime(hrtf_path / name) != mtime:
+            return False
+    return True
+
+
+def grid_angle(azimuth) -> int:
+    """Round an azimuth to the nearest whole degree, wrapped to [-180, 180)."""
+    return int((round(float(azimuth)) - GRID_START) % GRID_SIZE + GRID_START)
+
+
+def onset_delay(hrir: np.ndarray) -> float:
+    """Onset of an HRIR in samples: first crossing of ONSET_THRESHOLD * peak, linearly interpolated."""
+    env = np.abs(hrir)
+    level = ONSET_THRESHOLD * env.max()
+    i = int(np.argmax(env >= level))
+    if i == 0:
+        return 0.0
+    return i - 1 + (level - env[i - 1]) / (env[i] - env[i - 1])
+
+
+def minimum_phase_spectrum(magnitude: np.ndarray, n_fft: int = INTERP_FFT) -> np.ndarray:
+    """Minimum-phase spectrum with the given rfft magnitude (homomorphic method)."""
+    cepstrum = np.fft.irfft(np.log(np.maximum(magnitude, 1e-8)), n=n_fft)
+    fold = np.zeros(n_fft)
+    fold[0] = 1
+    fold[1:n_fft // 2] = 2
+    fold[n_fft // 2] = 1
+    return np.exp(np.fft.rfft(cepstrum * fold, n=n_fft))
+
+
+def delayed_filter(spectrum: np.ndarray, delay: float, taps: int, n_fft: int = INTERP_FFT) -> np.ndarray:
+    """Impulse response of `spectrum` delayed by a (fractional) number of samples, cut to `taps`."""
+    omega = np.pi * np.arange(len(spectrum)) / (len(spectrum) - 1)
+    return np.fft.irfft(spectrum * np.exp(-1j * omega * delay), n=n_fft)[:taps]
+
+
+def interpolate_hrirs(angles: list, hrirs: np.ndarray) -> np.ndarray:
+    """
+    Build the 1° table for one subject from its measured (angles, ears, taps) HRIRs.
+
+    Grid points that were measured are copied unchanged and points between two
+    measured angles are interpolated. The circle wraps: points past the last
+    measured angle (e.g. 167-179 when 166 is the last) are interpolated towards
+    the first one (-180) as it comes round again at +360.
+    """
+    n_ears, taps = hrirs.shape[1:]
+    delays = np.array([[onset_delay(h) for h in pair] for pair in hrirs])
+    magnitudes = np.abs(np.fft.rfft(hrirs, n=INTERP_FFT, axis=-1))
+    order = np.argsort(angles)
+    measured = np.array([angles[i] for i in order])
+    # The last measured angle is also met one turn earlier, and the first one turn later
+    wrapped = np.concatenate([[measured[-1] - GRID_SIZE], measured, [measured[0] + GRID_SIZE]])
+    wrapped_order = np.concatenate([[order[-1]], order, [order[0]]])
+
+    table = np.zeros((GRID_SIZE, n_ears, taps), dtype=np.float32)
+    for g, az in enumerate(range(GRID_START, GRID_START + GRID_SIZE)):
+        k = int(np.searchsorted(measured, az))
+        if k < len(measured) and measured[k] == az:
+            table[g] = hrirs[order[k]]
+            continue
+        k = int(np.searchsorted(wrapped, az, side="right"))
+        if wrapped[k - 1] == az:
+            table[g] = hrirs[wrapped_order[k - 1]]
+            continue
+        w = (az - wrapped[k - 1]) / (wrapped[k] - wrapped[k - 1])
+        i0, i1 = wrapped_order[k - 1], wrapped_order[k]
+        for ear in range(n_ears):
+            magnitude = (1 - w) * magnitudes[i0, ear] + w * magnitudes[i1, ear]
+            delay = (1 - w) * delays[i0, ear] + w * delays[i1, ear]
+            table[g, ear] = delayed_filter(minimum_phase_spectrum(magnitude), delay, taps)
+    return table
+
+
+def compact_tables(table: np.ndarray, max_error_db: float = MINPHASE_MAX_ERROR_DB) -> tuple[np.ndarray, np.ndarray, float]:
+    """
+    Split (..., ears, taps) HRIRs into truncated minimum-phase filters and interaural delays.
+
+    The minimum-phase part is cut to the shortest length in MINPHASE_TAPS whose
+    worst RMS log-spectral error (bins within MINPHASE_FLOOR_DB of the peak) is
+    at most `max_error_db`, with a half-Hann fade over its last quarter.
+    Delays are per-ear onsets minus the earlier ear's onset, so the common
+    propagation delay is dropped and only the ITD is kept.
+    Returns (minphase, delays, error_db).
+    """
+    shape, taps = table.shape[:-1], table.shape[-1]
+    hrirs = np.asarray(table, dtype=np.float64).reshape(-1, taps)
+    magnitudes = np.abs(np.fft.rfft(hrirs, n=INTERP_FFT, axis=-1))
+    minphase = np.fft.irfft(np.array([minimum_phase_spectrum(m) for m in magnitudes]), n=INTERP_FFT, axis=-1)
+    mask = magnitudes > magnitudes.max(axis=-1, keepdims=True) * 10 ** (MINPHASE_FLOOR_DB / 20)
+
+    for n_taps in [t for t in MINPHASE_TAPS if t < taps] + [taps]:
+        fade = max(n_taps // 4, 1)
+        window = np.ones(n_taps)
+        window[-fade:] = np.hanning(2 * fade)[fade:]
+        short = minphase[:, :n_taps] * window
+        error = 20 * np.log10(np.maximum(np.abs(np.fft.rfft(short, n=INTERP_FFT, axis=-1)), 1e-12)
+                              / np.maximum(magnitudes, 1e-12))
+        error_db = float(np.max(np.sqrt(np.sum(error ** 2 * mask, axis=-1) / mask.sum(axis=-1))))
+        if error_db <= max_error_db:
+            break
+
+    onsets = np.array([onset_delay(h) for h in hrirs]).reshape(shape)
+    delays = onsets - onsets.min(axis=-1, keepdims=True)
+    return (short.reshape(shape + (n_taps,)).astype(np.float32), delays.astype(np.float32), error_db)
+
+
+def build_bank(hrtf_path: Path = HRTF_PATH, force: bool = False, max_error_db: float = MINPHASE_MAX_ERROR_DB) -> bool:
+    """Compile all .mat HRIRs into the bank. Returns True if a rebuild happened."""
+    if not force and bank_is_current(hrtf_path):
+        return False
+
+    sources = _source_files(hrtf_path)
+    if not sources:
+        raise FileNotFoundError(f"No HRIR files found in {hrtf_path}")
+
+    hrirs = {}
+    for name, key in sources.items():
+        data = loadmat(str(hrtf_path / name))
+        if not all(ear in data for ear in EARS):
+            raise KeyError(f"Missing hrir_left or hrir_right in HRIR file {name}")
+        hrirs[key] = [data[ear].flatten() for ear in EARS]
+
+    subjects = sorted({subject for subject, _ in hrirs})
+    angles = {s: sorted(az for subject, az in hrirs if subject == s) for s in subjects}
+    taps = max(len(h) for pair in hrirs.values() for h in pair)
+    n_angles = max(len(a) for a in angles.values())
+
+    bank = np.zeros((len(subjects), n_angles, len(EARS), taps), dtype=np.float32)
+    for s_idx, subject in enumerate(subjects):
+        for a_idx, az in enumerate(angles[subject]):
+            for ear, h in enumerate(hrirs[(subject, az)]):
+                bank[s_idx, a_idx, ear, :len(h)] = h
+
+    interp = np.zeros((len(subjects), GRID_SIZE, len(EARS), taps), dtype=np.float32)
+    for s_idx, subject in enumerate(subjects):
+        n = len(angles[subject])
+        interp[s_idx] = interpolate_hrirs(angles[subject], bank[s_idx, :n])
+    minphase, itd, error_db = compact_tables(interp, max_error_db)
+
+    index = {
+        "version": BANK_VERSION,
+        "shape": list(bank.shape),
+        "grid": {"start": GRID_START, "size": GRID_SIZE},
+        "minphase": {"taps": minphase.shape[-1], "max_error_db": max_error_db, "error_db": error_db},
+        "subjects": subjects,
+        "angles": angles,
+        "sources": {name: os.path.getmtime(hrtf_path / name) for name in sources},
+    }
+
+    # Write to temp files first so a reader never sees a half-written bank
+    index_path = hrtf_path / INDEX_FILE
+    for name, table in zip(TABLE_FILES, (bank, interp, minphase, itd)):
+        with open(hrtf_path / f"{name}.tmp", "wb") as f:
+            np.save(f, table)
+    with open(f"{index_path}.tmp", "w") as f:
+        json.dump(index, f, indent=2)
+    for name in TABLE_FILES:
+        os.replace(hrtf_path / f"{name}.tmp", hrtf_path / name)
+    os.replace(f"{index_path}.tmp", index_path)
+
+    print(f"Built HRIR bank {hrtf_path / BANK_FILE}: {len(subjects)} subjects, {len(sources)} HRIRs, {taps} taps")
+    print(f"  Compact filters: {minphase.shape[-1]} taps, {error_db:.2f} dB worst RMS spectral error")
+    return True
+
+
+class HRIRBank:
+    """Memory-mapped HRIR bank with a (subject, azimuth) -> row index."""
+
+    def __init__(self, hrtf_path: Path = HRTF_PATH):
+        self.path = hrtf_path
+        with open(hrtf_path / INDEX_FILE, 'r') as f:
+            index = json.load(f)
+        self.data = np.load(hrtf_path / BANK_FILE, mmap_mode='r')
+        self.interp = np.load(hrtf_path / INTERP_FILE, mmap_mode='r')
+        self.minphase = np.load(hrtf_path / MINPHASE_FILE, mmap_mode='r')
+        self.itd = np.load(hrtf_path / ITD_FILE, mmap_mode='r')
+        self.subjects = index["subjects"]
+        self.angles = {s: list(a) for s, a in index["angles"].items()}
+        self.taps = self.data.shape[-1]
+        self.index = {
+            (subject, az): (s_idx, a_idx)
+            for s_idx, subject in enumerate(self.subjects)
+            for a_idx, az in enumerate(self.angles[subject])
+        }
+
+    def get(self, subject: str, azimuth) -> np.ndarray:
+        """Return the (2, taps) [left, right] HRIR view for a measured azimuth."""
+        key = (str(subject), int(azimuth))
+        if key not in self.index:
+            raise KeyError(f"No HRIR for Subject_{subject} at {azimuth}° in {self.path}")
+        s_idx, a_idx = self.index[key]
+        return self.data[s_idx, a_idx]
+
+    def lookup(self, subject: str, azimuth) -> np.ndarray:
+        """Return the (2, taps) HRIR view for any azimuth, from the 1° interpolated table."""
+        subject = str(subject)
+        if subject not in self.subjects:
+            raise KeyError(f"No HRIRs for Subject_{subject} in {self.path}")
+        return self.interp[self.subjects.index(subject), grid_angle(azimuth) - GRID_START]
+
+    def lookup_compact(self, subject: str, azimuth) -> tuple[np.ndarray, np.ndarray]:
+        """Return the (2, short_taps) minimum-phase filters and (2,) delays for any azimuth."""
+        subject = str(subject)
+        if subject not in self.subjects:
+            raise KeyError(f"No HRIRs for Subject_{subject} in {self.path}")
+        s_idx, g_idx = self.subjects.index(subject), grid_angle(azimuth) - GRID_START
+        return self.minphase[s_idx, g_idx], self.itd[s_idx, g_idx]
+
+
+def get_bank(hrtf_path: Path = HRTF_PATH) -> HRIRBank:
+    """Return the process-wide bank, rebuilding it first if the .mat files changed."""
+    global _bank
+    if _bank is None or _bank.path != hrtf_path:
+        build_bank(hrtf_path)
+        _bank = HRIRBank(hrtf_path)
+    return _bank
+
+
+def get_hrir(subject: str, azimuth, itd_scale: float = 1.0) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Return (hrir_left, hrir_right) for a subject at any azimuth, rounded to 1°.
+
+    With itd_scale, the later ear is shifted by a fractional delay so its
+    interaural delay is multiplied by `itd_scale`, as in compact_hrir().
+    """
+    hrir = get_bank().lookup(subject, azimuth)
+    if itd_scale == 1.0:
+        return hrir[0], hrir[1]
+    _, delays = get_bank().lookup_compact(subject, azimuth)
+    shifts = delays * (itd_scale - 1)
+    taps = hrir.shape[-1] + int(np.ceil(max(shifts.max(), 0)))
+    hrir = [delayed_filter(np.fft.rfft(h, n=INTERP_FFT), d, taps).astype(np.float32)
+            for h, d in zip(hrir, shifts)]
+    return hrir[0], hrir[1]
+
+
+def itd_scale(effective_radius, subject: str) -> float:
+    """
+    Factor that maps a subject's interaural delays to a listener's head.
+
+    The spherical head model (calibrateUserProfile.spherical_head_model) makes
+    the ITD proportional to the effective radius at every azimuth, so the ratio
+    of radii is enough. Clamped to ITD_SCALE_RANGE and rounded to 0.01 so
+    profiles with nearly the same radius share cached filters.
+    """
+    reference = SUBJECT_RADIUS_CM.get(str(subject))
+    if not reference or not effective_radius:
+        return 1.0
+    low, high = ITD_SCALE_RANGE
+    return round(min(max(float(effective_radius) / reference, low), high), 2)
+
+
+def compact_hrir(subject: str, azimuth, itd_scale: float = 1.0) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Return (hrir_left, hrir_right) rebuilt from the compact form: the short
+    minimum-phase filter of each ear shifted by its (fractional) interaural delay,
+    multiplied by `itd_scale`. Both are ceil(max delay) + short_taps long.
+    """
+    minphase, delays = get_bank().lookup_compact(subject, azimuth)
+    delays = delays * itd_scale
+    taps = minphase.shape[-1] + int(np.ceil(delays.max()))
+    hrir = [delayed_filter(np.fft.rfft(h, n=INTERP_FFT), d, taps).astype(np.float32)
+            for h, d in zip(minphase, delays)]
+    return hrir[0], hrir[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or check the compiled HRIR bank.")
+    parser.add_argument("command", choices=["build", "check"])
+    parser.add_argument("--path", type=Path, default=HRTF_PATH, help="Directory holding the .mat HRIRs")
+    parser.add_argument("--force", action="store_true", help="Rebuild even if the bank is current")
+    parser.add_argument("--max-error-db", type=float, default=MINPHASE_MAX_ERROR_DB,
+                        help="Worst RMS log-spectral error allowed when choosing the compact filter length")
+    args = parser.parse_args()
+
+    if args.command == "check":
+        current = bank_is_current(args.path)
+        print("HRIR bank is current." if current else "HRIR bank is stale or missing.")
+        sys.exit(0 if current else 1)
+
+    if not build_bank(args.path, force=args.force, max_error_db=args.max_error_db):
+        print("HRIR bank is already current.")
+
+
+if __name__ == "__main__":
+    main()
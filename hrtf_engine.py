@@ -0,0 +1,200 @@
+"""
+FFT overlap-add convolution engine for HRTF rendering.
+
+Replaces scipy.signal.lfilter(hrir, 1, signal) for long signals. The input is
+cut into blocks of `block_size` samples, each block is multiplied by the cached
+HRIR spectrum and the results are overlap-added, so the cost per sample is
+O(log block_size) instead of O(taps).
+
+Output matches lfilter (same length, zero initial state) to within float32
+rounding: for inputs in [-1, 1] the max abs difference is below 1e-5
+(see bench_hrtf_engine.py).
+
+With compact=True the engine uses the bank's short minimum-phase filters plus
+interaural delay instead of the stored HRIRs, which roughly halves the filter
+length and lets a given FFT size carry a longer block.
+
+Passing itd_scale (from hrir_bank.itd_scale and the profile's effective
+radius) rescales the interaural delay of every HRIR to the listener's head,
+stored or compact. The delay is baked into the cached spectrum, so it costs
+nothing per sample.
+"""
+import threading
+
+import numpy as np
+from scipy import fft as sp_fft
+
+from hrir_bank import compact_hrir, get_hrir, grid_angle
+
+FS = 44100
+DEFAULT_BLOCK_SIZE = 4096
+BLOCKS_PER_BATCH = 16  # Blocks transformed per FFT call when rendering a whole signal
+
+_engine = None
+_engine_lock = threading.Lock()
+_tuning_thread = None
+
+
+def _next_pow2(n: int) -> int:
+    return 1 << (int(n) - 1).bit_length()
+
+
+class ConvolutionEngine:
+    """Block FFT convolver with a cache of HRIR spectra."""
+
+    def __init__(self, block_size: int = DEFAULT_BLOCK_SIZE, blocks_per_batch: int = BLOCKS_PER_BATCH,
+                 compact: bool = False):
+        self.block_size = block_size
+        self.blocks_per_batch = blocks_per_batch
+        self.compact = compact
+        self._spectra = {}
+
+    def hrir(self, subject: str, azimuth, itd_scale: float = 1.0) -> np.ndarray:
+        """(2, taps) HRIR pair used for rendering: stored, or compact if enabled."""
+        if self.compact:
+            return np.stack(compact_hrir(subject, azimuth, itd_scale))
+        return np.stack(get_hrir(subject, azimuth, itd_scale))
+
+    def fft_size(self, taps: int) -> int:
+        """FFT length needed to convolve one block with a `taps` long filter without wrap-around."""
+        return _next_pow2(self.block_size + taps - 1)
+
+    def spectrum(self, hrir: np.ndarray, key=None) -> np.ndarray:
+        """Return the (ears, bins) spectrum of a (ears, taps) HRIR, cached under `key` if given."""
+        hrir = np.atleast_2d(hrir)
+        n_fft = self.fft_size(hrir.shape[-1])
+        if key is not None and (key, n_fft) in self._spectra:
+            return self._spectra[(key, n_fft)]
+        spec = sp_fft.rfft(np.asarray(hrir, dtype=np.float32), n=n_fft, axis=-1)
+        if key is not None:
+            self._spectra[(key, n_fft)] = spec
+        return spec
+
+    def hrtf_spectrum(self, subject: str, azimuth, itd_scale: float = 1.0) -> np.ndarray:
+        """Cached (2, bins) spectrum of the HRIR pair for a subject and azimuth (rounded to 1°)."""
+        return self.spectrum(self.hrir(subject, azimuth, itd_scale),
+                             key=(str(subject), grid_angle(azimuth), itd_scale))
+
+    def convolve(self, signal: np.ndarray, spec: np.ndarray, tail: np.ndarray = None) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Convolve a mono signal with a (ears, bins) spectrum.
+
+        Returns (out, tail): `out` is (ears, len(signal)) and `tail` is the overlap
+        that belongs to the samples after `signal`. Pass the tail back in to
+        continue the same stream with the next chunk.
+        """
+        return self.mix(np.asarray(signal)[None], spec[None], tail)
+
+    def mix(self, signals: np.ndarray, specs: np.ndarray, tail: np.ndarray = None) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Convolve each of (inputs, n) mono signals with its own (ears, bins) spectrum
+        and sum them.
+
+        The products are summed in the frequency domain, so only one inverse FFT
+        per ear and block is needed no matter how many inputs are mixed.
+        Returns (out, tail) like convolve().
+        """
+        B = self.block_size
+        n_fft = 2 * (specs.shape[-1] - 1)
+        hops = -(-n_fft // B)  # Output blocks each frame spans; blocks need not divide n_fft
+        ears = specs.shape[1]
+        n_inputs, n = signals.shape
+        n_blocks = -(-n // B)
+
+        signals = np.asarray(signals, dtype=np.float32)
+        out = np.zeros((ears, (n_blocks + hops - 1) * B), dtype=np.float32)
+        if tail is not None:
+            out[:, :tail.shape[-1]] += tail
+
+        for start in range(0, n_blocks, self.blocks_per_batch):
+            stop = min(start + self.blocks_per_batch, n_blocks)
+            frames = np.zeros((n_inputs, (stop - start) * B), dtype=np.float32)
+            chunk = signals[:, start * B:stop * B]
+            frames[:, :chunk.shape[-1]] = chunk
+            frames = frames.reshape(n_inputs, -1, B)
+
+            # (inputs, blocks, bins) x (inputs, ears, bins) -> (ears, blocks, bins)
+            X = sp_fft.rfft(frames, n=n_fft, axis=-1)
+            Y = np.einsum('ibk,iek->ebk', X, specs)
+            y = sp_fft.irfft(Y, n=n_fft, axis=-1)
+            if hops * B > n_fft:
+                y = np.pad(y, ((0, 0), (0, 0), (0, hops * B - n_fft)))
+            for k in range(hops):
+                seg = y[:, :, k * B:(k + 1) * B].reshape(ears, -1)
+                out[:, (start + k) * B:(start + k) * B + seg.shape[-1]] += seg
+
+        return out[:, :n], out[:, n:n + n_fft - B].copy()
+
+    def render(self, signal: np.ndarray, subject: str, azimuth, itd_scale: float = 1.0) -> np.ndarray:
+        """Drop-in for lfilter-based HRTF rendering: mono in, (N, 2) float32 out."""
+        out, _ = self.convolve(signal, self.hrtf_spectrum(subject, azimuth, itd_scale))
+        return np.ascontiguousarray(out.T)
+
+    def render_mix(self, stems: dict, stem_directions: dict, subject: str, itd_scale: float = 1.0) -> np.ndarray:
+        """
+        Render several mono stems at their own azimuths straight to one binaural mix.
+
+        `stems` maps stem name -> mono signal and `stem_directions` maps stem name
+        -> azimuth (the profile's "stem_directions"). Returns the (N, 2) float32
+        sum of all rendered stems; the caller applies any mix gain.
+        """
+        names = list(stems)
+        n = max(len(stems[name]) for name in names)
+        signals = np.zeros((len(names), n), dtype=np.float32)
+        for i, name in enumerate(names):
+            signals[i, :len(stems[name])] = stems[name]
+        specs = np.stack([self.hrtf_spectrum(subject, stem_directions.get(name, 0), itd_scale) for name in names])
+
+        out, _ = self.mix(signals, specs)
+        return np.ascontiguousarray(out.T)
+
+
+def _tune(after: threading.Thread = None):
+    global _engine
+    if after is not None:
+        after.join()
+    from engine_tuning import tune  # engine_tuning imports this module
+    tuning = tune()
+    with _engine_lock:
+        if _engine is None or (_engine.block_size, _engine.blocks_per_batch) != (tuning["block_size"],
+                                                                                 tuning["blocks_per_batch"]):
+            _engine = ConvolutionEngine(block_size=tuning["block_size"], blocks_per_batch=tuning["blocks_per_batch"])
+
+
+def tune_in_background(after: threading.Thread = None) -> threading.Thread:
+    """
+    Measure the block size for this machine in a background thread, if the
+    stored tuning is missing or stale (see engine_tuning.py). get_engine()
+    returns the tuned engine once it is done.
+
+    With `after` (e.g. the separator's preload thread), tuning waits for
+    that thread to finish so the two do not compete for the CPU.
+    """
+    global _tuning_thread
+    with _engine_lock:
+        if _tuning_thread is None:
+            _tuning_thread = threading.Thread(target=_tune, args=(after,), daemon=True)
+            _tuning_thread.start()
+    return _tuning_thread
+
+
+def get_engine() -> ConvolutionEngine:
+    """
+    Return the process-wide engine so HRIR spectra are shared between callers.
+
+    Uses the block size tuned for this machine (see engine_tuning.py). If the
+    stored result is missing or stale, the tuner is started in the background
+    and DEFAULT_BLOCK_SIZE is used until it finishes, so no render waits for it.
+    """
+    global _engine
+    with _engine_lock:
+        if _engine is not None:
+            return _engine
+        from engine_tuning import load_tuning  # engine_tuning imports this module
+        tuning = load_tuning()
+        if tuning is not None:
+            _engine = ConvolutionEngine(block_size=tuning["block_size"], blocks_per_batch=tuning["blocks_per_batch"])
+            return _engine
+        _engine = ConvolutionEngine()
+    tune_in_background()
+    return _engine
@@ -11,10 +11,14 @@ from gpiozero.exc import GPIOZeroError
 import threading
 import stt
 from calibrateUserProfile import run_calibration
-from utility import run_spatial_audio, apply_bulk_hrtf, summed_signal_from_file, summed_stems_from_file, apply_selected_hrtf
+from utility import run_spatial_audio, load_profile_data, spatial_stems_path, ensure_stems
+from spatial_stream import StreamingRenderer, SpatialStreamPlayer
+from stem_store import STORE_SUFFIX, STEMS, stems_watermark, stored_targets
+from hrir_bank import itd_scale
+from hrtf_engine import tune_in_background
+from unmix_separator import get_separator
 from datetime import datetime
 from menu_app_modular.battery_monitor import get_battery_info
-import soundfile as sf
 from CalibrateV3 import run_calibration_function
 from editProfiles import edit_profile
 from PIL import Image, ImageDraw, ImageFont
@@ -67,6 +71,8 @@ directory = None
 # For Speech to Text
 recognition_thread = None
 recognition_running = False
+# For streamed spatial playback
+spatial_player = None
 
 # Menu definitions with labels, targets, and actions
 menus = {
@@ -118,7 +124,9 @@ menus = {
     "title": "Song Options",
     "options": [  # These will be updated dynamically when entering the menu
         {"label": "Play Song", "target": None, "action_type": "python", "action": "play_single_song"},
-        {"label": "Apply Spatial Audio", "target": None, "action": "apply_spatial_audio", "action_type": "python"},
+        {"label": "Spatial Audio: Fast", "target": None, "action": "apply_spatial_fast", "action_type": "python"},
+        {"label": "Spatial Audio: Quality", "target": None, "action": "apply_spatial_audio", "action_type": "python"},
+        {"label": "Apply Spatial Stems", "target": None, "action": "apply_spatial_stems", "action_type": "python"},
         {"label": "Back", "target": "back"}
     ]
     },
@@ -167,18 +175,16 @@ def play_stems():
     if selected_song and os.path.exists(stems_directory):
         print("Loaded Profile: ", Loaded_Profile)
         selected_stems = select_profile()
+        if not selected_stems:
+            print("No stems selected")
+            return
         img = Image.new("RGB", (SCREEN_HEIGHT, SCREEN_WIDTH), "WHITE")
         draw = ImageDraw.Draw(img)
         draw.text((SCREEN_HEIGHT//2 - len("Processing..."), SCREEN_WIDTH//2), "Processing...", font=font_large, fill="BLACK")
         img = img.rotate(90, expand=True)
         update_display(img)
-        apply_selected_hrtf(stems_directory=stems_directory, Loaded_Profile=Loaded_Profile, selected_stems=selected_stems)
-        print("Generate Summed Song")
-        final_output = summed_stems_from_file(stems_directory, selected_stems=selected_stems)
-        print("Write Stems to flac")
-        sf.write('Music/output.flac', final_output, 44100)
-        print("Play stems with music player")
-        stt.play_button("output.flac")
+        print("Stream selected stems")
+        start_spatial_stream(stems_directory, selected_stems=selected_stems)
 
 def select_profile():
     global LCD
@@ -250,13 +256,42 @@ def play_spatial_song():
     stems_directory = f"Spatial/{selected_song}"
     if selected_song and os.path.exists(stems_directory):
         print("Loaded Profile: ", Loaded_Profile)
-        apply_bulk_hrtf(stems_directory, Loaded_Profile=Loaded_Profile)
-        print("Generate summed song")
-        final_output = summed_signal_from_file(stems_directory)
-        print("Write Stems to flac")
-        sf.write('Music/output.flac', final_output, 44100)
-        print("Play spatial track with music player")
-        stt.play_button("output.flac")
+        print("Stream spatial track")
+        start_spatial_stream(stems_directory)
+
+def start_spatial_stream(stems_directory, selected_stems=None):
+    """Render the stems block by block and play them as they are rendered."""
+    global spatial_player
+    stop_spatial_stream()
+    stt.hold_song()
+    wanted = set(selected_stems or STEMS)
+    if not wanted <= set(stored_targets(stems_directory)):
+        img = Image.new("RGB", (SCREEN_HEIGHT, SCREEN_WIDTH), "WHITE")
+        draw = ImageDraw.Draw(img)
+        draw.text((SCREEN_HEIGHT//2 - len("Processing..."), SCREEN_WIDTH//2), "Processing...", font=font_large, fill="BLACK")
+        img = img.rotate(90, expand=True)
+        update_display(img)
+        # Separate the missing stems in the background, as run_spatial_audio_helper does
+        separation = threading.Thread(target=ensure_stems, args=(stems_directory, sorted(wanted)), daemon=True)
+        separation.start()
+        wait_for_stems(separation, stems_directory, wanted)
+        if not wanted <= set(stored_targets(stems_directory)):
+            print("Could not separate the selected stems")
+            return
+    profile_data = load_profile_data(Loaded_Profile)
+    head_scale = itd_scale(profile_data["effective_radius"], profile_data["hrtf_subject"])
+    renderer = StreamingRenderer(stems_directory, profile_data["stem_directions"], profile_data["hrtf_subject"],
+                                 selected_stems=selected_stems, itd_scale=head_scale)
+    spatial_player = SpatialStreamPlayer(renderer, volume=stt.get_volume)
+    spatial_player.start()
+
+def stop_spatial_stream():
+    global spatial_player
+    if spatial_player is not None:
+        spatial_player.stop()
+        spatial_player = None
+
+stt.on_play = stop_spatial_stream  # Every VLC play path (menus, skip, voice commands) stops the stream first
 
 # Function for loading music files dynamically into pages
 def load_profile_files(directory="user_profiles"):
@@ -309,9 +344,7 @@ def load_music_files(directory="Music", page=0):
             wav = sorted([f for f in files if f.lower().endswith(".wav")]) # Sort for .wav
             all_music_files = sorted(mp3s + flac + wav)
         elif directory == "Spatial":
-            pkl = sorted([f for f in files if f.lower().endswith(".pkl")]) # Sort for .pkl
-            h5 = sorted([f for f in files if f.lower().endswith(".h5")]) # Sort for .h5
-            all_music_files = sorted(pkl + h5)
+            all_music_files = sorted([f for f in files if f.endswith(STORE_SUFFIX)]) # Stem stores (see stem_store)
         current_page = page # Select starting page from parameter variable
 
         # Determine how many songs to put per page. Adjustable from global variable "items_per_page"
@@ -376,13 +409,37 @@ def start_voice():
 def clear_console(): # For manually clearing the console
     os.system('cls' if os.name == 'nt' else 'clear')
 
-def run_spatial_audio_helper():
+def apply_spatial_stems_helper():
+    # Separate only the stems the user picks; others are separated later if asked for
+    selected_stems = select_profile()
+    if selected_stems:
+        run_spatial_audio_helper(selected_stems)
+
+def apply_spatial_fast_helper():
+    # Quick HPSS preview stems; "Spatial Audio: Quality" replaces them later
+    run_spatial_audio_helper(tier="fast")
+
+def wait_for_stems(separation, stems_directory, wanted):
+    """Wait while a separation thread runs, until the first segment of the stems in `wanted` can be streamed."""
+    while separation.is_alive() and not (stems_watermark(stems_directory)[0] > 0
+                                         and wanted <= set(stored_targets(stems_directory))):
+        time.sleep(0.5)
+
+def run_spatial_audio_helper(selected_stems=None, tier="quality"):
     img = Image.new("RGB", (SCREEN_HEIGHT, SCREEN_WIDTH), "WHITE")
     draw = ImageDraw.Draw(img)
     draw.text((SCREEN_HEIGHT//2 - len("Processing..."), SCREEN_WIDTH//2), "Processing...", font=font_large, fill="BLACK")
     img = img.rotate(90, expand=True)
     update_display(img)
-    run_spatial_audio(f"Music/{selected_song}")
+    # Separate in the background in time order and start playing once the first segment is ready
+    # (asking for quality over a fast preview plays the preview while the quality stems are made)
+    stems_directory = spatial_stems_path(f"Music/{selected_song}")
+    separation = threading.Thread(target=run_spatial_audio, args=(f"Music/{selected_song}",),
+                                  kwargs={"progressive": True, "targets": selected_stems, "tier": tier}, daemon=True)
+    separation.start()
+    wait_for_stems(separation, stems_directory, set(selected_stems or STEMS))
+    if stems_watermark(stems_directory)[0] > 0:
+        start_spatial_stream(stems_directory, selected_stems=selected_stems)
 
 def change_profile_wrapper():
     global current_index, Loaded_Profile
@@ -396,7 +453,12 @@ def change_profile_wrapper():
     return f"Profile {temp_str} loaded Successfully"
 
 def play_pause():
-    if song_paused == True:
+    if spatial_player is not None and spatial_player.is_active():
+        if spatial_player.is_paused():
+            spatial_player.resume()
+        else:
+            spatial_player.pause()
+    elif song_paused == True:
         stt.resume_song()
     elif song_paused == False:
         stt.pause_song()
@@ -463,6 +525,8 @@ function_dictionary = {
     "play_single_song" : play_button_wrapper,
     "run_calibration" : run_calibration_wrapper,
     "apply_spatial_audio" : run_spatial_audio_helper,
+    "apply_spatial_fast" : apply_spatial_fast_helper,
+    "apply_spatial_stems" : apply_spatial_stems_helper,
     "play_spatial_song" : play_spatial_song,
     "play_stems" : play_stems,
     "edit_profiles" : run_edit_profiles_wrapper,
@@ -675,10 +739,15 @@ def draw_menu():
                 paste_image("/home/brendendack/SeniorDesignCode/github_code/SeniorDesign/assets/main_menu/play.png", (1, 91), resize=(15, 15))
 
         if current_menu_key == "submenu_Music_Player":
-            time_left = stt.get_remaining_time()
+            if spatial_player is not None and spatial_player.is_active():
+                seconds_left = spatial_player.remaining_seconds()
+                time_left = None if seconds_left is None else "Time left: {:.2f} seconds".format(seconds_left)
+                current = os.path.basename(spatial_player.renderer.stems_directory).removesuffix(STORE_SUFFIX)
+            else:
+                time_left = stt.get_remaining_time()
+                current = stt.song_current()
             if time_left == None:
                 time_left = "No Song Playing"
-            current = stt.song_current()
             if current == None:
                 current = "No Song Playing"
             draw.text((SCREEN_WIDTH/2 - len(label), 100), current, font=font_menu, fill="BLACK")
@@ -762,6 +831,8 @@ def main():
         LCD = LCD_2inch4()
         LCD.Init()
         LCD.clear()
+        preload = get_separator().preload()  # Load the separation model while the boot screen shows
+        tune_in_background(after=preload)  # Measure the HRTF block size on first boot, once the model is loaded
         # Create an image at the start so it persists across function execution
         img = Image.new("RGB", (320, 240), "WHITE")
         paste_image("/home/brendendack/SeniorDesignCode/github_code/SeniorDesign/assets/boot.png", (0,0), resize=(320, 240))
@@ -0,0 +1,186 @@
+"""
+One-time conversion of saved stems to stem stores (see stem_store).
+
+Converts, under SPATIAL_DIR:
+- HDF5 stem files from run_spatial_audio, in any codec and in float32 or the
+  compact int16/float16 formats. This includes the stem_cache entries that
+  Spatial/<song>.h5 links point at; those links are replaced by
+  Spatial/<song>.stems links to the converted entries.
+- pickle files from save_stems_to_pkl_v1 (Spatial/<song>.pkl indexed by
+  Spatial/<song>_metadata.pkl or Spatial/metadata.pkl) and
+  save_stems_to_pkl_v2 (Spatial/<song>/stems.pkl and metadata.pkl).
+
+Stems are copied one block at a time and keep their format; float64 stems
+become float32. Files that are still being separated are skipped. The
+converted files are deleted unless --keep is given.
+
+    python migrate_stems.py [--keep]
+"""
+import argparse
+import os
+import pickle
+
+import h5py
+import numpy as np
+
+from stem_cache import CACHE_DIR, link, unlink
+from stem_store import STEM_FORMATS, STORE_SUFFIX, StemReader, StemStore, replace_store
+
+SPATIAL_DIR = "Spatial"
+MUSIC_DIR = "Music"
+MUSIC_EXTENSIONS = (".mp3", ".flac", ".wav")  # What the menus list in Music/
+COPY_FRAMES = 1 << 20  # Frames copied at a time
+
+
+def _json_value(value):
+    """An HDF5 attribute as a JSON-serializable value."""
+    if isinstance(value, bytes):
+        return value.decode()
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def find_source(name_only):
+    """The song in Music/ a stem file was made from, if it is still there."""
+    for extension in MUSIC_EXTENSIONS:
+        path = os.path.join(MUSIC_DIR, name_only + extension)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def convert_h5(h5_path, store_path, name_only=None) -> bool:
+    """Copy an HDF5 stem file into a new stem store; False if it was not finished."""
+    with h5py.File(h5_path, "r") as f:
+        if not f.attrs.get("complete", True):
+            print(f"Skipping {h5_path}: still being separated")
+            return False
+        attrs = {key: _json_value(value) for key, value in f.attrs.items()}
+        if "source" not in attrs and name_only and find_source(name_only):
+            attrs["source"] = find_source(name_only)
+        store = StemStore.create(f"{store_path}.part", **attrs)
+        for name, dataset in f.items():
+            if not isinstance(dataset, h5py.Dataset) or not dataset.attrs.get("complete", True):
+                continue  # The "scales" group, or a stem an interrupted append left behind
+            stem_format = str(dataset.attrs.get("format", "float32"))
+            if stem_format not in STEM_FORMATS:
+                stem_format = "float32"
+            scales = f["scales"][name] if stem_format != "float32" else None
+            reader = StemReader(dataset, scales)
+            writer = store.writer(name, len(reader), stem_format)
+            for start in range(0, len(reader), COPY_FRAMES):
+                writer.write(reader.read(start, start + COPY_FRAMES))
+            # Keep the peak and the quality report of the original write; copying the samples is exact
+            entry = {key: float(dataset.attrs[key]) for key in ("mono_peak", "snr_db", "peak_error")
+                     if key in dataset.attrs}
+            writer.close(**entry)
+            store.mono_peak(name)  # Scanned now if the file did not record it
+    replace_store(f"{store_path}.part", store_path)
+    return True
+
+
+def convert_pickle(data_file, metadata, store_path, name_only):
+    """Copy the stems of a pickle file into a new stem store, seeking to each by its metadata offset."""
+    store = StemStore.create(f"{store_path}.part", **({"source": find_source(name_only)}
+                                                       if find_source(name_only) else {}))
+    with open(data_file, "rb") as f:
+        for name, entry in metadata.items():
+            f.seek(entry["offset"])
+            stem = np.asarray(pickle.load(f), dtype=np.float32)
+            if stem.ndim == 1:
+                stem = stem[:, None]
+            if stem.shape[0] == 2 and stem.shape[1] > 2:
+                stem = stem.T  # Saved channels first
+            if stem.shape[1] == 1:
+                stem = np.repeat(stem, 2, axis=1)  # Mono
+            store.write(name, stem[:, :2])
+            store.mono_peak(name)
+    replace_store(f"{store_path}.part", store_path)
+
+
+def pickle_metadata(data_file, name_only):
+    """The offset index of a save_stems_to_pkl_v1/v2 data file, or None if it cannot be found."""
+    candidates = [os.path.join(os.path.dirname(data_file), "metadata.pkl")]
+    if os.path.basename(data_file) != "stems.pkl":
+        candidates.insert(0, os.path.join(SPATIAL_DIR, f"{name_only}_metadata.pkl"))
+    for metadata_file in candidates:
+        if not os.path.exists(metadata_file):
+            continue
+        with open(metadata_file, "rb") as f:
+            metadata = pickle.load(f)
+        # v1 shares Spatial/metadata.pkl between songs; each entry names its song
+        metadata = {name: entry for name, entry in metadata.items()
+                    if entry.get("song", os.path.basename(name_only)) in (name_only, os.path.basename(name_only))}
+        if metadata:
+            return metadata_file, metadata
+    return None, None
+
+
+def migrate(keep=False):
+    """Convert every old stem file under SPATIAL_DIR; returns the number of stores written."""
+    converted = 0
+    # Cache entries first, so links to them can be pointed at the converted stores
+    if CACHE_DIR.exists():
+        for entry in sorted(CACHE_DIR.glob("*.h5")):
+            store_path = entry.with_suffix(STORE_SUFFIX)
+            if not store_path.exists():
+                print(f"Converting cache entry {entry.name}")
+                if not convert_h5(entry, store_path):
+                    continue
+                converted += 1
+            if not keep:
+                entry.unlink()
+
+    old_files = []
+    for directory, subdirectories, files in os.walk(SPATIAL_DIR):
+        # Stem stores and the cache are already converted
+        subdirectories[:] = [name for name in subdirectories
+                             if not name.endswith(STORE_SUFFIX) and os.path.join(directory, name) != str(CACHE_DIR)]
+        for file in sorted(files):
+            path = os.path.join(directory, file)
+            name_only = os.path.splitext(os.path.relpath(path, SPATIAL_DIR))[0]
+            if file.endswith(".h5") and os.path.islink(path):
+                key = os.path.splitext(os.path.basename(os.readlink(path)))[0]
+                if (CACHE_DIR / f"{key}{STORE_SUFFIX}").exists():
+                    print(f"Linking {name_only}{STORE_SUFFIX} to cache entry {key}")
+                    link(os.path.join(SPATIAL_DIR, name_only + STORE_SUFFIX), key)
+                    if not keep:
+                        unlink(path)
+            elif file.endswith(".h5"):
+                print(f"Converting {path}")
+                if convert_h5(path, os.path.join(SPATIAL_DIR, name_only + STORE_SUFFIX), name_only):
+                    converted += 1
+                    old_files.append(path)
+            elif file.endswith(".pkl") and file != "metadata.pkl" and not file.endswith("_metadata.pkl"):
+                if file == "stems.pkl":
+                    name_only = os.path.relpath(directory, SPATIAL_DIR)  # v2: Spatial/<song>/stems.pkl
+                metadata_file, metadata = pickle_metadata(path, name_only)
+                if metadata is None:
+                    print(f"Skipping {path}: no metadata to find its stems")
+                    continue
+                print(f"Converting {path}")
+                convert_pickle(path, metadata, os.path.join(SPATIAL_DIR, name_only + STORE_SUFFIX), name_only)
+                converted += 1
+                old_files.append(path)
+                if os.path.basename(metadata_file) != "metadata.pkl" or file == "stems.pkl":
+                    old_files.append(metadata_file)  # The shared v1 index may still list other songs
+
+    if not keep:
+        for path in old_files:
+            os.remove(path)
+            print(f"Removed {path}")
+            directory = os.path.dirname(path)
+            if os.path.normpath(directory) != SPATIAL_DIR and not os.listdir(directory):
+                os.rmdir(directory)  # A save_stems_to_pkl_v2 song folder
+    print(f"Converted {converted} stem files")
+    return converted
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert HDF5 and pickle stem files to stem stores.")
+    parser.add_argument("--keep", action="store_true", help="Keep the old files after converting them")
+    args = parser.parse_args()
+    migrate(keep=args.keep)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+"""
+Cache of rendered binaural mixes.
+
+Playing a song renders every stem through the HRTFs again, even when
+neither the stems nor the profile have changed. Finished mixes are kept
+in CACHE_DIR as (frames, 2) float32 .npy files. Each is keyed by everything
+it depends on:
+- its base (render_base): the content of the selected stems (see stems_id),
+  the profile's HRTF subject and interaural delay scale, the renderer,
+  RENDER_VERSION (bumped whenever rendering changes) and the compiled HRIR
+  bank;
+- the direction of each selected stem.
+
+A repeat play maps the cached mix and starts at once. After a profile edit
+moves some stems, nearest_render finds the cached mix of the same base that
+differs in the fewest stems. Only the moved stems are rendered against it,
+as a correction with the difference of their old and new HRTFs (see
+render_moved). Moving a stem back to an angle it had before is a cache hit.
+
+Only whole mixes are cached, not each stem's render: the stems of a
+4-minute song would add about 5 x 85 MB of writes to every cold play, while
+a correction to the nearest mix only convolves the stems that moved.
+
+The cache's index (see disk_cache) records the base and directions of each
+mix and when it was last used. When the cache grows past CACHE_MAX_MB, the
+least recently used mixes are deleted.
+"""
+import hashlib
+import json
+import os
+import time as Time
+from pathlib import Path
+
+import numpy as np
+
+from disk_cache import PART_SUFFIX, DiskCache
+from hrir_bank import HRTF_PATH, INDEX_FILE as BANK_INDEX_FILE
+
+CACHE_DIR = Path("Spatial/renders")
+RENDER_VERSION = 2  # Bump when a renderer's output changes, so old renders are not played
+CACHE_MAX_MB = 2048  # Mixes kept on the SD card (about 85 MB per 4-minute song and profile)
+
+cache = DiskCache(CACHE_DIR, ".npy", RENDER_VERSION, CACHE_MAX_MB, "render")
+entry_path = cache.entry_path
+evict = cache.evict
+
+
+def stems_id(store, stem_names) -> dict:
+    """
+    What identifies the content of stem_names in a stem store (see stem_store).
+
+    This is the store's real path (a stem_cache entry is named after the
+    audio and separation), each stem's manifest entry, and the size and
+    mtime of its file. Separating a stem again changes it.
+    """
+    stems = {}
+    for name in stem_names:
+        stat = os.stat(store.stem_path(name))
+        stems[name] = {"entry": store.stems[name], "stamp": [stat.st_size, stat.st_mtime_ns]}
+    return {"store": os.path.realpath(store.path), "stems": stems}
+
+
+def bank_id() -> str:
+    """Digest of the compiled HRIR bank's index, which changes whenever the bank is rebuilt differently."""
+    try:
+        with open(HRTF_PATH / BANK_INDEX_FILE, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return ""
+
+
+def _key(identity: dict) -> str:
+    identity = json.dumps({**identity, "version": RENDER_VERSION, "bank": bank_id()}, sort_keys=True)
+    return hashlib.sha256(identity.encode()).hexdigest()[:32]
+
+
+def render_base(store, stem_names, subject: str, itd_scale: float, renderer: str) -> str:
+    """What a mix of stem_names from a complete stem store depends on, apart from the stems' directions."""
+    return _key({
+        "stems": stems_id(store, stem_names),
+        "selected": sorted(stem_names),
+        "subject": subject,
+        "itd_scale": round(float(itd_scale), 6),
+        "renderer": renderer,
+    })
+
+
+def render_key(base: str, directions: dict) -> str:
+    """Cache key of the mix of a base with its stems at directions ({stem name: azimuth})."""
+    return _key({"base": base, "directions": directions})
+
+
+def lookup(key: str):
+    """Path of the cached render for key, marking it as used, or None if it is not cached."""
+    path = entry_path(key)
+    if not path.exists():
+        return None
+    cache.touch(key)
+    return path
+
+
+def nearest_render(base: str, directions: dict):
+    """
+    (path, directions) of the cached mix of base whose directions differ
+    from `directions` in the fewest stems, marking it as used; None if no
+    mix of base is cached.
+    """
+    with cache.lock:
+        entries = cache.load_index()["entries"]
+    nearest = None
+    for key, entry in entries.items():
+        if entry.get("base") != base or not entry_path(key).exists():
+            continue
+        moved = sum(entry["directions"].get(name) != azimuth for name, azimuth in directions.items())
+        if nearest is None or moved < nearest[0]:
+            nearest = (moved, key, entry["directions"])
+    if nearest is None:
+        return None
+    cache.touch(nearest[1])
+    return entry_path(nearest[1]), nearest[2]
+
+
+def render_moved(engine, store, previous, previous_directions: dict, directions: dict, subject: str,
+                 itd_scale: float):
+    """
+    Yield the mix of a complete stem store with its stems at `directions`,
+    in engine.block_size blocks, from `previous`, a cached mix of the same
+    base (see nearest_render) with the stems at previous_directions.
+
+    Convolution is linear, so the new mix is the previous one plus each
+    moved stem convolved with the difference of its new and old HRTFs.
+    Only the moved stems are read and convolved, in one pass with
+    engine.mix().
+    """
+    B = engine.block_size
+    moved = [name for name in directions if previous_directions.get(name) != directions[name]]
+    specs = np.stack([engine.hrtf_spectrum(subject, directions[name], itd_scale)
+                      - engine.hrtf_spectrum(subject, previous_directions[name], itd_scale)
+                      for name in moved])
+    gain = 1.0 / len(directions)
+    readers = [store.reader(name) for name in moved]
+    # Same scaling as Stereo_to_mono: 0.5 * (L + R) / peak
+    scales = [0.5 / (store.mono_peak(name) or 1.0) for name in moved]
+
+    tail = None
+    for start in range(0, len(previous), B):
+        stop = min(start + B, len(previous))
+        signals = np.empty((len(readers), stop - start), dtype=np.float32)
+        for i, (reader, scale) in enumerate(zip(readers, scales)):
+            signals[i] = reader.read_mono(start, stop, scale)
+
+        out, tail = engine.mix(signals, specs, tail)
+        yield previous[start:stop] + out.T * gain
+
+
+class RenderWriter:
+    """
+    Writes a mix of n_frames into the cache in consecutive blocks. It only
+    becomes visible to lookup() and nearest_render() on close(); discard()
+    drops a render that was stopped part way.
+    """
+
+    def __init__(self, n_frames: int, base: str, directions: dict):
+        self.key = render_key(base, directions)
+        self.base = base
+        self.directions = directions
+        self.path = entry_path(self.key)
+        self.tmp_path = self.path.with_name(self.path.name + PART_SUFFIX)
+        self.mix = np.lib.format.open_memmap(self.tmp_path, mode="w+", dtype=np.float32, shape=(n_frames, 2))
+        self.frames = 0
+
+    def write(self, block):
+        self.mix[self.frames:self.frames + len(block)] = block
+        self.frames += len(block)
+
+    def close(self):
+        if self.frames != len(self.mix):
+            self.discard()
+            return
+        self.mix.flush()
+        del self.mix
+        os.replace(self.tmp_path, self.path)
+        with cache.edit_index() as index:
+            index["entries"][self.key] = {"base": self.base, "directions": self.directions, "last_used": Time.time()}
+        evict(keep={self.key})
+
+    def discard(self):
+        self.mix = None
+        if self.tmp_path.exists():
+            self.tmp_path.unlink()
+
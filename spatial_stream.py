@@ -0,0 +1,239 @@
+"""
+Streaming binaural renderer.
+
+Instead of rendering a whole song to Music/output.flac before playback, stems
+are read from the stem store (see stem_store) one block at a time, mixed through the HRTF
+engine with the overlap tail carried between blocks, and written straight to
+the sound card. A render thread keeps a short queue of blocks ahead of an
+output thread, so the first block plays as soon as it is rendered.
+
+Stem stores that are still being separated progressively (see
+utility.separate_to_file) can be played too: the renderer only reads up to
+the store's "ready_frames" watermark and waits for it to advance.
+
+Renders of finished stores are saved to render_cache as they play.
+Playing the same song with the same profile again reads the mix back
+instead of rendering it. After a profile edit, only the stems whose
+direction changed are rendered, as a correction to the cached mix.
+"""
+import queue
+import threading
+import time as Time
+
+import numpy as np
+import pyaudio
+
+import render_cache
+from hrtf_engine import ConvolutionEngine
+from stem_store import BLOCK_FRAMES, FS, STEMS, StemStore
+
+STREAM_BLOCK_SIZE = BLOCK_FRAMES  # ~46 ms at 44.1 kHz; compact stems are scaled in these blocks
+QUEUE_BLOCKS = 32  # ~1.5 s of rendered audio buffered ahead of playback
+WATERMARK_POLL = 0.2  # Seconds between watermark checks while waiting for separation
+WATERMARK_TIMEOUT = 300  # Give up if separation makes no progress for this long
+
+
+class StreamingRenderer:
+    """Iterate over (block_size, 2) float32 binaural blocks of a stem store."""
+
+    def __init__(self, stems_directory, stem_directions: dict, subject: str, selected_stems=None,
+                 block_size: int = STREAM_BLOCK_SIZE, itd_scale: float = 1.0, cache: bool = True):
+        self.stems_directory = stems_directory
+        self.stem_directions = stem_directions
+        self.subject = subject
+        self.itd_scale = itd_scale
+        self.selected_stems = selected_stems or STEMS
+        self.engine = ConvolutionEngine(block_size=block_size)
+        self.cache = cache
+        self.frames = None  # Length of the song, known once iteration has opened the store
+        self._cancel = threading.Event()
+
+    def cancel(self):
+        """Stop waiting for separation; iteration ends at the next watermark check."""
+        self._cancel.set()
+
+    def _wait_until_ready(self, store, stop: int) -> bool:
+        """Wait until frames [0, stop) are separated. False if cancelled or separation stalled."""
+        last_ready, last_change = None, Time.monotonic()
+        while not store.attrs.get("complete", True) and int(store.attrs.get("ready_frames", 0)) < stop:
+            ready = int(store.attrs.get("ready_frames", 0))
+            if ready != last_ready:
+                last_ready, last_change = ready, Time.monotonic()
+            if self._cancel.wait(WATERMARK_POLL) or Time.monotonic() - last_change > WATERMARK_TIMEOUT:
+                return False
+            store.reload()
+        return True
+
+    def __iter__(self):
+        store = StemStore(self.stems_directory)
+        if not self._wait_until_ready(store, 1):
+            return
+        self.frames = min(len(store.reader(name)) for name in self.selected_stems)
+        if not (self.cache and store.attrs.get("complete", True)):
+            yield from self._render(store)
+            return
+
+        for name in self.selected_stems:
+            store.mono_peak(name)  # Recorded before the manifest is hashed into cache keys
+        base = render_cache.render_base(store, self.selected_stems, self.subject, self.itd_scale, "stream")
+        directions = {name: self.stem_directions.get(name, 0) for name in self.selected_stems}
+        path = render_cache.lookup(render_cache.render_key(base, directions))
+        if path is not None:
+            mix = np.load(path, mmap_mode="r")
+            for start in range(0, len(mix), self.engine.block_size):
+                if self._cancel.is_set():
+                    return
+                yield np.array(mix[start:start + self.engine.block_size])
+            return
+
+        nearest = render_cache.nearest_render(base, directions)
+        moved = [name for name in self.selected_stems
+                 if nearest is not None and nearest[1].get(name) != directions[name]]
+        if nearest is not None and len(moved) < len(self.selected_stems):
+            print(f"Rendering {', '.join(moved)} over a cached mix")
+            blocks = render_cache.render_moved(self.engine, store, np.load(nearest[0], mmap_mode="r"), nearest[1],
+                                               directions, self.subject, self.itd_scale)
+        else:
+            blocks = self._render(store)
+        writer = render_cache.RenderWriter(self.frames, base, directions)
+        try:
+            for block in blocks:
+                writer.write(block)
+                yield block
+            writer.close()  # Discards the render instead if it stopped early
+        finally:
+            writer.discard()
+
+    def _render(self, store):
+        B = self.engine.block_size
+        specs = np.stack([self.engine.hrtf_spectrum(self.subject, self.stem_directions.get(name, 0),
+                                                    self.itd_scale)
+                          for name in self.selected_stems])
+        gain = 1.0 / len(self.selected_stems)
+
+        readers = [store.reader(name) for name in self.selected_stems]
+        if store.attrs.get("complete", True):
+            # Same scaling as Stereo_to_mono: 0.5 * (L + R) / peak
+            scales = [0.5 / (store.mono_peak(name) or 1.0) for name in self.selected_stems]
+        else:
+            # The stems' own peaks are only known once separation finishes; the
+            # mix peak bounds them and keeps the level steady for the whole song
+            scales = [0.5 / (float(store.attrs["mix_mono_peak"]) or 1.0)] * len(readers)
+        n = min(len(reader) for reader in readers)
+
+        tail = None
+        for start in range(0, n, B):
+            stop = min(start + B, n)
+            if not self._wait_until_ready(store, stop):
+                print("Spatial stream stopped: separation did not finish")
+                return
+            signals = np.empty((len(readers), stop - start), dtype=np.float32)
+            for i, (reader, scale) in enumerate(zip(readers, scales)):
+                signals[i] = reader.read_mono(start, stop, scale)
+
+            out, tail = self.engine.mix(signals, specs, tail)
+            yield np.ascontiguousarray(out.T * gain)
+
+
+class SpatialStreamPlayer:
+    """
+    Play a StreamingRenderer through PyAudio while it renders.
+
+    `volume` returns the app's current volume, 0 to 100 like VLC's; it is
+    read for every block, so volume buttons and voice-command ducking apply
+    straight away.
+    """
+
+    def __init__(self, renderer, output_device_index=None, queue_blocks: int = QUEUE_BLOCKS, volume=None):
+        self.renderer = renderer
+        self.output_device_index = output_device_index
+        self.volume = volume
+        self.frames_played = 0
+        self._queue = queue.Queue(maxsize=queue_blocks)
+        self._stop = threading.Event()
+        self._playing = threading.Event()
+        self._threads = []
+
+    def start(self):
+        self._playing.set()
+        self._threads = [
+            threading.Thread(target=self._render_loop, daemon=True),
+            threading.Thread(target=self._output_loop, daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def pause(self):
+        self._playing.clear()
+
+    def resume(self):
+        self._playing.set()
+
+    def is_paused(self) -> bool:
+        return not self._playing.is_set()
+
+    def is_active(self) -> bool:
+        return any(thread.is_alive() for thread in self._threads)
+
+    def remaining_seconds(self):
+        """Seconds left to play, or None before the renderer knows the song's length."""
+        if self.renderer.frames is None:
+            return None
+        return max(self.renderer.frames - self.frames_played, 0) / FS
+
+    def stop(self):
+        self._stop.set()
+        self._playing.set()
+        self.renderer.cancel()
+        for thread in self._threads:
+            thread.join(timeout=1)
+
+    def _put(self, item) -> bool:
+        # Block while the queue is full, but give up as soon as stop() is called
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _render_loop(self):
+        try:
+            for block in self.renderer:
+                if not self._put(block):
+                    return
+        except Exception as e:
+            print(f"Spatial render error: {e}")
+        self._put(None)
+
+    def _output_loop(self):
+        p = pyaudio.PyAudio()
+        stream = None
+        try:
+            stream = p.open(format=pyaudio.paFloat32,
+                            channels=2,
+                            rate=FS,
+                            output=True,
+                            output_device_index=self.output_device_index,
+                            frames_per_buffer=self.renderer.engine.block_size)
+            while not self._stop.is_set():
+                if not self._playing.wait(timeout=0.1):
+                    continue
+                try:
+                    block = self._queue.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if block is None:
+                    break
+                if self.volume is not None:
+                    block = block * np.float32(min(max(self.volume(), 0), 100) / 100)
+                stream.write(block.tobytes())
+                self.frames_played += len(block)
+        except Exception as e:
+            print(f"Spatial output error: {e}")
+        finally:
+            if stream is not None:
+                stream.stop_stream()
+                stream.close()
+            p.terminate()
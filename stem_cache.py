@@ -0,0 +1,122 @@
+"""
+Content-addressed cache of separated stems.
+
+Stem stores (see stem_store) live in CACHE_DIR under a key made from a hash
+of the decoded audio and the separation parameters (model, quantization,
+the stems separated together and the chunk windows), not under the song's
+file name. Spatial/<song>.stems, which the menus
+list and play, is a symlink to the cache entry. So:
+
+- renaming a song, or having it in two folders, finds the same stems;
+- a song whose audio changed gets new stems instead of the stale ones;
+- retagging a file (which only changes metadata) keeps its stems.
+
+The cache's index (see disk_cache) maps each song path to its audio hash,
+stamped with the file's size and mtime so unchanged songs are not decoded
+again just to be hashed, and records when each entry was last used and
+which links point to it. When the cache grows past CACHE_MAX_MB, the least
+recently used entries are deleted together with those links.
+"""
+import hashlib
+import json
+import os
+import time as Time
+from pathlib import Path
+
+import numpy as np
+
+from audio_decode import decode_blocks
+from disk_cache import DiskCache
+from stem_store import STORE_SUFFIX, replace_store, stems_watermark
+
+CACHE_DIR = Path("Spatial/cache")
+CACHE_VERSION = 1  # Bump when stored stems change meaning, to start a fresh cache
+CACHE_MAX_MB = 4096  # Stems kept on the SD card before the least recently used are evicted
+
+cache = DiskCache(CACHE_DIR, STORE_SUFFIX, CACHE_VERSION, CACHE_MAX_MB, "stems")
+entry_path = cache.entry_path
+touch = cache.touch
+
+
+def audio_hash(file_name) -> str:
+    """sha256 of a song's decoded 44.1 kHz float32 samples; reused while the file's size and mtime match."""
+    song = os.path.normpath(file_name)
+    stat = os.stat(song)
+    stamp = [stat.st_size, stat.st_mtime_ns]
+    with cache.lock:
+        known = cache.load_index().get("songs", {}).get(song)
+    if known is not None and known["stamp"] == stamp:
+        return known["hash"]
+
+    digest = hashlib.sha256()
+    for block in decode_blocks(song):
+        digest.update(np.ascontiguousarray(block).data)
+    with cache.edit_index() as index:
+        index.setdefault("songs", {})[song] = {"stamp": stamp, "hash": digest.hexdigest()}
+    return digest.hexdigest()
+
+
+def separation_key(file_name, params: dict) -> str:
+    """Cache key of the stems of file_name separated with params, e.g. {"model": "umxl", "quantized": False, ...}."""
+    identity = json.dumps({"audio": audio_hash(file_name), "params": params}, sort_keys=True)
+    return hashlib.sha256(identity.encode()).hexdigest()[:32]
+
+
+def lookup(key: str):
+    """Path of the finished stems for key, marking them as used, or None if they are not cached."""
+    path = entry_path(key)
+    if not stems_watermark(str(path))[1]:
+        return None
+    touch(key)
+    return path
+
+
+def link(link_path, key: str):
+    """Point link_path (e.g. Spatial/song.stems) at the cache entry for key, replacing what it pointed at."""
+    link_path = os.path.normpath(link_path)
+    os.makedirs(os.path.dirname(link_path) or ".", exist_ok=True)
+    tmp_path = link_path + ".link"
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+    os.symlink(os.path.relpath(entry_path(key), os.path.dirname(link_path) or "."), tmp_path)
+    os.replace(tmp_path, link_path)
+    with cache.edit_index() as index:
+        for entry in index["entries"].values():
+            if link_path in entry.get("links", []):
+                entry["links"].remove(link_path)
+        entry = index["entries"].setdefault(key, {})
+        entry.setdefault("links", []).append(link_path)
+        entry["last_used"] = Time.time()
+
+
+def adopt(path, key: str):
+    """Move a stem store written before the cache existed into it under key, leaving a link in its place."""
+    replace_store(path, entry_path(key))
+    link(path, key)
+
+
+def unlink(link_path):
+    """Remove a link made by link() and drop it from the index."""
+    link_path = os.path.normpath(link_path)
+    if os.path.islink(link_path):
+        os.remove(link_path)
+    with cache.edit_index() as index:
+        for entry in index["entries"].values():
+            if link_path in entry.get("links", []):
+                entry["links"].remove(link_path)
+
+
+def _remove_links(key: str, entry: dict):
+    # Links the index lost track of are found by looking for links into the entry beside the cache
+    target = os.path.realpath(entry_path(key))
+    links = set(entry.get("links", []))
+    links.update(item.path for item in os.scandir(CACHE_DIR.parent)
+                 if item.is_symlink() and os.path.realpath(item.path) == target)
+    for link_path in links:
+        if os.path.islink(link_path):
+            os.remove(link_path)
+
+
+def evict(max_bytes: int = None, keep=()):
+    """Delete least recently used entries (and their links) until the cache fits in max_bytes."""
+    cache.evict(max_bytes, keep, on_evict=_remove_links)
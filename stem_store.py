@@ -0,0 +1,348 @@
+"""
+Separated stems stored as memory-mapped .npy files.
+
+A stem store is a directory, Spatial/<song>.stems or an entry of
+stem_cache. It holds one <stem>.npy file of (frames, 2) samples per stem and
+a small MANIFEST_FILE:
+
+    {"version": 1,
+     "attrs": {"source": "Music/song.mp3", "tier": "quality", "complete": false,
+               "frames": 7938000, "ready_frames": 1323000, "mix_mono_peak": 1.7},
+     "stems": {"vocals": {"format": "float32", "frames": 7938000,
+                          "complete": false, "mono_peak": 1.2}, ...}}
+
+It replaces both the HDF5 stem files and the pickle files of
+save_stems_to_pkl_v1/v2. migrate_stems.py converts those. The manifest is
+read once when a StemStore is opened. Stems are mapped with np.load(mmap_mode="r")
+on first use, which reads only the .npy header. After that:
+- a read of any time range touches only the pages it covers;
+- a float32 stem is returned as a view of the mapping, not a copy;
+- nothing is decompressed or unpickled.
+
+Stem files are created at full length before separation starts and are
+filled in place. A store that is still being separated progressively can
+therefore be played: readers map the whole file, only read below
+attrs["ready_frames"], and call reload() to follow the watermark.
+
+Compact formats (opt-in with stem_format) store "int16" or "float16" samples
+instead of float32, at half the size and read I/O. Each BLOCK_FRAMES block
+is divided by its own peak before it is quantized, so quiet passages keep
+their resolution. The per-block factors go in <stem>.scales.npy.
+StemWriter reports the SNR of what it stored. StemReader applies the block
+factors while converting to float32. They are folded into the mono gain the
+renderers apply anyway, so decoding adds no pass over the samples.
+"""
+import json
+import os
+import shutil
+import threading
+from pathlib import Path
+
+import numpy as np
+
+BLOCK_FRAMES = 2048  # spatial_stream's streaming block; scale factors are per block
+STEM_FORMATS = {"float32": np.float32, "int16": np.int16, "float16": np.float16}
+STEM_FORMAT = "float32"
+INT16_FULL_SCALE = 32767
+MANIFEST_FILE = "manifest.json"
+STORE_VERSION = 1
+STORE_SUFFIX = ".stems"
+STEMS = ["vocals", "drums", "bass", "other"]
+FS = 44100
+
+_lock = threading.Lock()  # Separation threads and the players both update manifests
+
+
+def remove_store(path):
+    """Delete the stem store directory at path, if there is one (a link to a store is left alone)."""
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+
+
+def replace_store(src, dst):
+    """Move the store at src to dst, replacing the store there."""
+    remove_store(dst)
+    os.replace(src, dst)
+
+
+def store_size(path) -> int:
+    """Bytes of the files in a stem store."""
+    return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+
+def _write_manifest(path: Path, manifest: dict):
+    tmp_path = path / (MANIFEST_FILE + ".tmp")
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(tmp_path, path / MANIFEST_FILE)
+
+
+def stems_watermark(stems_directory) -> tuple[float, bool]:
+    """
+    (seconds ready, complete) for a stem store.
+
+    Stores written in one go have no watermark and count as complete; a missing
+    or unreadable store has nothing ready.
+    """
+    try:
+        store = StemStore(stems_directory)
+    except (OSError, ValueError):
+        return 0.0, False
+    complete = bool(store.attrs.get("complete", True))
+    if complete:
+        frames = min((entry["frames"] for name, entry in store.stems.items() if name in STEMS), default=0)
+    else:
+        frames = int(store.attrs.get("ready_frames", 0))
+    return frames / FS, complete
+
+
+def stored_targets(stems_directory) -> list:
+    """
+    Stems present in a stem store. Stems still being added by
+    utility.ensure_stems are left out; while the whole store is being
+    separated progressively, every stem counts.
+    """
+    try:
+        store = StemStore(stems_directory)
+    except (OSError, ValueError):
+        return []
+    in_progress = not store.attrs.get("complete", True)
+    return [name for name in STEMS if name in store and (in_progress or store.stems[name].get("complete", True))]
+
+
+def stems_tier(stems_directory):
+    """Separation tier ("fast" or "quality") of a stem store; stems from before tiers are "quality"."""
+    try:
+        return str(StemStore(stems_directory).attrs.get("tier", "quality"))
+    except (OSError, ValueError):
+        return None
+
+
+def stems_format(stems_directory):
+    """Storage format of a stem store's stems (see STEM_FORMATS); STEM_FORMAT for a store without stems."""
+    try:
+        formats = [entry.get("format", STEM_FORMAT) for entry in StemStore(stems_directory).stems.values()]
+    except (OSError, ValueError):
+        formats = []
+    return formats[0] if formats else STEM_FORMAT
+
+
+class StemStore:
+    """The stems of one song: lazily mapped stem files plus the manifest describing them."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._readers = {}
+        self.reload()
+
+    @classmethod
+    def create(cls, path, **attrs):
+        """Start an empty store at path with the given attrs, replacing any store there."""
+        path = Path(path)
+        remove_store(path)
+        path.mkdir(parents=True)
+        _write_manifest(path, {"version": STORE_VERSION, "attrs": attrs, "stems": {}})
+        return cls(path)
+
+    def reload(self):
+        """Re-read the manifest, e.g. to follow a separation that is still writing the store."""
+        with open(self.path / MANIFEST_FILE, 'r') as f:
+            manifest = json.load(f)
+        if manifest.get("version") != STORE_VERSION:
+            raise ValueError(f"{self.path} is stem store version {manifest.get('version')}, "
+                             f"expected {STORE_VERSION}")
+        self.attrs = manifest["attrs"]
+        self.stems = manifest["stems"]
+
+    def update(self, stem=None, **values):
+        """Set attrs, or the manifest entry of stem, and save the manifest."""
+        with _lock:
+            self.reload()
+            (self.stems.setdefault(stem, {}) if stem else self.attrs).update(values)
+            _write_manifest(self.path, {"version": STORE_VERSION, "attrs": self.attrs, "stems": self.stems})
+
+    def __contains__(self, name):
+        return name in self.stems
+
+    def stem_path(self, name, suffix=".npy") -> Path:
+        return self.path / f"{name}{suffix}"
+
+    def reader(self, name) -> "StemReader":
+        """Reader of a stem; its files are mapped on first use and kept mapped."""
+        if name not in self._readers:
+            if name not in self.stems:
+                raise KeyError(f"No stem '{name}' in {self.path}")
+            scales = None
+            if self.stems[name]["format"] != "float32":
+                scales = np.load(self.stem_path(name, ".scales.npy"), mmap_mode="r")
+            self._readers[name] = StemReader(np.load(self.stem_path(name), mmap_mode="r"), scales)
+        return self._readers[name]
+
+    def read(self, name) -> np.ndarray:
+        """A whole stem as (frames, 2) float32; for float32 stems, a view of the mapped file."""
+        return self.reader(name).read()
+
+    def writer(self, name, n_frames, stem_format=STEM_FORMAT) -> "StemWriter":
+        return StemWriter(self, name, n_frames, stem_format)
+
+    def write(self, name, data, stem_format=STEM_FORMAT, **entry):
+        """Store a whole (frames, 2) stem in one go; entry values (e.g. mono_peak) go in its manifest entry."""
+        writer = self.writer(name, len(data), stem_format)
+        writer.write(data)
+        return writer.close(**entry)
+
+    def delete(self, name):
+        """Remove a stem, e.g. one left over from an interrupted write."""
+        self._readers.pop(name, None)
+        for suffix in (".npy", ".scales.npy"):
+            if self.stem_path(name, suffix).exists():
+                self.stem_path(name, suffix).unlink()
+        if name in self.stems:
+            with _lock:
+                self.reload()
+                self.stems.pop(name, None)
+                _write_manifest(self.path, {"version": STORE_VERSION, "attrs": self.attrs, "stems": self.stems})
+
+    def mono_peak(self, name, read_size: int = 1 << 20) -> float:
+        """
+        Peak of the summed stereo channels of a stem, as used by utility.Stereo_to_mono.
+
+        Recorded in the manifest when the stem is separated. Stems without it
+        are scanned once and the peak is recorded when the store is writable.
+        """
+        peak = self.stems[name].get("mono_peak")
+        if peak is not None:
+            return float(peak)
+        reader = self.reader(name)
+        peak = 0.0
+        for start in range(0, len(reader), read_size):
+            mono = reader.read_mono(start, start + read_size)
+            peak = max(peak, float(np.max(np.abs(mono), initial=0.0)))
+        try:
+            self.update(name, mono_peak=peak)
+        except OSError:
+            pass  # Read-only; scan again next time
+        return peak
+
+
+class StemWriter:
+    """
+    Writes a stem of n_frames in consecutive blocks of any length.
+
+    Compact formats are encoded a whole BLOCK_FRAMES block at a time, so up
+    to one block is held back until the next write or close(); `frames` is
+    how much has been stored so far.
+    """
+
+    def __init__(self, store, name, n_frames, stem_format=STEM_FORMAT):
+        if stem_format not in STEM_FORMATS:
+            raise ValueError(f"Unknown stem format '{stem_format}', expected one of {list(STEM_FORMATS)}")
+        store.delete(name)
+        self.store = store
+        self.name = name
+        self.stem_format = stem_format
+        self.data = np.lib.format.open_memmap(store.stem_path(name), mode="w+", dtype=STEM_FORMATS[stem_format],
+                                              shape=(n_frames, 2))
+        self.scales = None
+        if stem_format != "float32":
+            self.scales = np.lib.format.open_memmap(store.stem_path(name, ".scales.npy"), mode="w+",
+                                                    dtype=np.float32, shape=(-(-n_frames // BLOCK_FRAMES),))
+        store.update(name, format=stem_format, frames=n_frames, complete=False)
+        self.frames = 0
+        self._pending = np.empty((0, 2), dtype=np.float32)
+        self._signal_energy = self._error_energy = self._peak_error = 0.0
+
+    def write(self, block):
+        block = np.asarray(block, dtype=np.float32)
+        if self.scales is None:
+            self.data[self.frames:self.frames + len(block)] = block
+            self.frames += len(block)
+            return
+        if len(self._pending):
+            block = np.concatenate((self._pending, block))
+        whole = len(block) - len(block) % BLOCK_FRAMES
+        self._encode(block[:whole])
+        self._pending = block[whole:]
+
+    def close(self, **entry) -> dict:
+        """
+        Store what is held back and mark the stem complete, with any extra
+        manifest entry values. Returns (and records) how faithful the stored stem is.
+        """
+        if len(self._pending):
+            self._encode(self._pending)
+            self._pending = self._pending[:0]
+        report = {"format": self.stem_format}
+        for array in (self.data, self.scales):
+            if isinstance(array, np.memmap):
+                array.flush()
+        if self.scales is not None:
+            snr_db = 10 * np.log10(max(self._signal_energy, 1e-20) / max(self._error_energy, 1e-20))
+            report.update(snr_db=float(min(snr_db, 200.0)), peak_error=self._peak_error)
+            print(f"{self.name}: stored as {self.stem_format}, SNR {report['snr_db']:.1f} dB, "
+                  f"peak error {report['peak_error']:.1e}")
+        self.store.update(self.name, **{"complete": True, **report, **entry})
+        return report
+
+    def _encode(self, block):
+        if not len(block):
+            return
+        starts = np.arange(0, len(block), BLOCK_FRAMES)
+        peaks = np.maximum.reduceat(np.abs(block).max(axis=1), starts)
+        scales = (peaks / INT16_FULL_SCALE if self.stem_format == "int16" else peaks).astype(np.float32)
+        frame_scales = np.repeat(scales, np.diff(starts, append=len(block)))[:, None]
+        normalized = block / np.where(frame_scales > 0, frame_scales, 1)
+        if self.stem_format == "int16":
+            encoded = np.rint(normalized).astype(np.int16)
+        else:
+            encoded = normalized.astype(np.float16)
+        error = encoded.astype(np.float32) * frame_scales - block
+        self._signal_energy += float(np.sum(np.square(block, dtype=np.float64)))
+        self._error_energy += float(np.sum(np.square(error, dtype=np.float64)))
+        self._peak_error = max(self._peak_error, float(np.max(np.abs(error), initial=0.0)))
+
+        first = self.frames // BLOCK_FRAMES
+        self.data[self.frames:self.frames + len(block)] = encoded
+        self.scales[first:first + len(scales)] = scales
+        self.frames += len(block)
+
+
+class StemReader:
+    """
+    Reads float32 frames of a (frames, 2) stem array of any format, with its
+    per-block scales for compact formats. Works on mapped .npy files and on
+    the HDF5 datasets migrate_stems.py reads.
+    """
+
+    def __init__(self, data, scales=None):
+        self.data = data
+        self.scales = scales
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    def frame_scales(self, start, stop):
+        """Scale factor of every frame in [start, stop); a scalar when the range is inside one block."""
+        first, last = start // BLOCK_FRAMES, (stop - 1) // BLOCK_FRAMES
+        scales = self.scales[first:last + 1]
+        if first == last:
+            return scales[0]
+        return np.repeat(scales, BLOCK_FRAMES)[start - first * BLOCK_FRAMES:stop - first * BLOCK_FRAMES]
+
+    def read(self, start=0, stop=None) -> np.ndarray:
+        """(frames, 2) float32 frames [start, stop); float32 stems are not copied."""
+        stop = len(self) if stop is None else min(stop, len(self))
+        block = self.data[start:stop]
+        if self.scales is None or stop <= start:
+            return block.astype(np.float32, copy=False)
+        return np.multiply(block, np.reshape(self.frame_scales(start, stop), (-1, 1)), dtype=np.float32)
+
+    def read_mono(self, start, stop, gain=1.0) -> np.ndarray:
+        """(L + R) * gain of frames [start, stop) as float32, with the block scales folded into the gain."""
+        stop = min(stop, len(self))
+        block = self.data[start:stop]
+        mono = np.add(block[:, 0], block[:, 1], dtype=np.float32)
+        if self.scales is not None and stop > start:
+            gain = self.frame_scales(start, stop) * np.float32(gain)
+        mono *= gain
+        return mono
@@ -42,6 +42,7 @@ except OSError as e:
 instance = vlc.Instance('--aout=alsa')
 player = instance.media_player_new()
 tts_player = instance.media_player_new()  # Global player for text-to-speech
+on_play = None  # Called before VLC starts playing, so another player (main_pillow's spatial stream) can stop
 
 # Define specific paths to avoid overlap
 NORMAL_MUSIC_PATH = os.path.join(MUSIC_FOLDER, "Music").lower()
@@ -84,6 +85,10 @@ def speak(text):
         while tts_player.is_playing():
             time.sleep(0.1)  # Prevent overlap
 
+def before_play():
+    if on_play is not None:
+        on_play()
+
 # Function to detect wake word "Hey Music"
 def detect_wake_word(audio_chunk):
     if rec.AcceptWaveform(audio_chunk):
@@ -134,6 +139,7 @@ def play_song(song_name):
     if song_file:
         media = instance.media_new(song_file)
         player.set_media(media)
+        before_play()
         player.play()
         print(f"Now playing: {os.path.basename(song_file)}")
         speak(f"Now playing {os.path.splitext(os.path.basename(song_file))[0]}")
@@ -148,6 +154,7 @@ def play_buttons(): #this is for playing general playlist
     song_path = playlist[current_index]
     media = instance.media_new(song_path)
     player.set_media(media)
+    before_play()
     player.play()
 
 def play_button(selected_song): 
@@ -161,6 +168,7 @@ def play_button(selected_song):
             current_index = i
             media = instance.media_new(path)
             player.set_media(media)
+            before_play()
             player.play()
             print(f"Now playing: {os.path.basename(path)}")
             break
@@ -179,6 +187,7 @@ def checkFinish(): #this checks when the vlc has ended
                     song_path = playlist[current_index]
                     media = instance.media_new(song_path)
                     player.set_media(media)
+                    before_play()
                     player.play()
                 else:
                     next_song()
@@ -197,8 +206,13 @@ def pause_song():
     player.pause()
    # speak("Song paused.")
 
+# Pause without toggling, e.g. when another player takes over the output
+def hold_song():
+    player.set_pause(1)
+
 # Resume function
 def resume_song():
+    before_play()
     player.play()
     #speak("Song resumed.")
 
@@ -222,6 +236,7 @@ def next_song():
     song_path = playlist[current_index]
     media = instance.media_new(song_path)
     player.set_media(media)
+    before_play()
     player.play()
     print(f"Playing next song: {os.path.basename(song_path)}")
     #speak("Playing next song.")
@@ -244,6 +259,7 @@ def previous_song():
     song_path = playlist[current_index]
     media = instance.media_new(song_path)
     player.set_media(media)
+    before_play()
     player.play()
     print(f"Playing previous song: {os.path.basename(song_path)}")
     last_played_index = current_index # update the last song that was played
@@ -265,21 +281,31 @@ def toggle_shuffle():
 # Volume control functions (new functionality, for the purpose of being able to hear during music)
 NORMAL_VOLUME = 75 #80
 LOW_VOLUME = 40
+volume = 100  # Last volume set, VLC's default until then; the spatial stream plays at this volume too
 
 def lower_volume():
+    global volume
+    volume = LOW_VOLUME
     player.audio_set_volume(LOW_VOLUME)
     print("Volume lowered to", LOW_VOLUME)
 
 def restore_volume():
+    global volume
+    volume = NORMAL_VOLUME
     player.audio_set_volume(NORMAL_VOLUME)
     print("Volume restored to", NORMAL_VOLUME)
 
 # system update Volume    
 def update_volume(increment ,GLOBAL_VOLUME):
+    global volume
+    volume = GLOBAL_VOLUME + increment
     player.audio_set_volume(GLOBAL_VOLUME + increment)
     
     return GLOBAL_VOLUME    
 
+def get_volume():
+    return volume
+
 def get_remaining_time():
 
     if player.get_length() == -1:
@@ -390,6 +416,7 @@ def start_voice_recognition():
                     song_path = playlist[current_index]
                     media = instance.media_new(song_path)
                     player.set_media(media)
+                    before_play()
                     player.play()
                 else:
                     next_song()
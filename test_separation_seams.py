@@ -0,0 +1,56 @@
+"""
+Chunked separation must match whole-track separation at the window seams.
+
+A stand-in model replaces openunmix so no weights are needed: it splits off
+a "bass" stem with a zero-phase one-pole lowpass. Its response lasts about
+a second, as long as the overlap, so like the real model every output sample
+depends on the audio around it and windows differ from the whole track near
+their edges. Cutting from one window to the next without the crossfade
+leaves an error the threshold catches.
+"""
+import numpy as np
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("openunmix")
+
+from scipy.signal import lfilter
+
+import unmix_separator
+from check_separation_seams import FS, SEAM_THRESHOLD_DB, seam_errors
+from unmix_separator import ResidentSeparator
+
+STAND_IN_TAU = 0.1  # Seconds; the response is still -87 dB after a 1 s overlap
+
+
+class StandInSeparator(ResidentSeparator):
+    def load(self):
+        return None  # No weights
+
+    def separate(self, samples, rate=FS, targets=None):
+        a = np.exp(-1 / (STAND_IN_TAU * rate))
+        bass = lfilter([1 - a], [1, -a], samples, axis=0)
+        bass = lfilter([1 - a], [1, -a], bass[::-1], axis=0)[::-1]  # Backwards too, for zero phase
+        estimates = {"bass": bass, "other": samples - bass}
+        return {target: estimate.astype(np.float32) for target, estimate in estimates.items()
+                if targets is None or target in targets}
+
+
+def noise_excerpt():
+    return np.random.default_rng(0).uniform(-0.5, 0.5, (12 * FS, 2)).astype(np.float32)
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_seam_error_below_threshold(workers):
+    errors = seam_errors(StandInSeparator(), noise_excerpt(), window_seconds=4, overlap_seconds=1, workers=workers)
+    for target, (seam_db, _) in errors.items():
+        assert seam_db < SEAM_THRESHOLD_DB, f"{target}: seam error {seam_db:.1f} dB"
+
+
+# A fade-in of all zeros keeps the previous window up to the end of the overlap,
+# all ones switches to the next window at its start
+@pytest.mark.parametrize("fade", [0.0, 1.0])
+def test_hard_cut_exceeds_threshold(monkeypatch, fade):
+    monkeypatch.setattr(unmix_separator, "crossfade", lambda n: np.full((n, 1), fade, dtype=np.float32))
+    errors = seam_errors(StandInSeparator(), noise_excerpt(), window_seconds=4, overlap_seconds=1)
+    assert max(seam_db for seam_db, _ in errors.values()) > SEAM_THRESHOLD_DB
@@ -0,0 +1,400 @@
+"""
+Resident openunmix separator.
+
+openunmix.predict.separate() loads the pretrained weights and builds a new
+Separator on every call unless one is passed in. On the device that load is
+a large fixed part of every "Apply Spatial Audio", so the app keeps a single
+Separator alive for the whole session: weights are loaded once (optionally
+in the background at startup with preload()) and each song only pays for
+inference.
+
+Inference runs under torch.inference_mode() with TORCH_THREADS intra-op
+threads. One core is left free for the UI, speech recognition and playback
+threads; separation is not faster with an oversubscribed CPU anyway.
+
+separate_chunked() handles tracks too long to separate in one pass: the
+model sees overlapping windows of WINDOW_SECONDS, the overlaps are
+crossfaded, and finished blocks are handed to the caller as they are ready,
+so peak memory depends on the window length and not on the track length.
+With workers > 1 the windows are separated in a pool of forked processes
+that share the loaded weights copy-on-write, one single-threaded worker per
+core, and stitched back in order with the same crossfades.
+
+Passing targets (e.g. ["vocals", "other"]) runs only those target models,
+which share the loaded weights, so inference cost scales with the number of
+stems asked for. A residual source stands in for the rest of the mix during
+Wiener filtering, so the chosen stems do not absorb the others.
+
+With quantized=True the LSTM and linear layers, which dominate CPU time, are
+converted to dynamic int8 with torch.quantization.quantize_dynamic. The
+converted weights are cached next to the torch hub downloads, keyed by
+model and torch version, so later sessions skip the float load and
+conversion (see bench_quantized_separation.py for speed and quality).
+
+`python unmix_separator.py export` scripts the target models with
+TorchScript and freezes them into TORCHSCRIPT_DIR next to the app. When that
+artifact is present and was exported from the same model, torch and
+openunmix versions, load() reads the frozen graphs instead of building the
+Python modules from the hub weights, which starts faster and runs with less
+Python dispatch per layer. The STFT, Wiener filtering and iSTFT still go
+through openunmix's Separator, so predict.separate is used either way; a
+missing or stale artifact just means the regular weights are loaded.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import threading
+import time as Time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from importlib import metadata
+from pathlib import Path
+
+import numpy as np
+import openunmix
+import torch
+from openunmix import model, predict, utils
+
+FS = 44100
+MODEL_NAME = "umxl"  # Same default as openunmix.predict.separate
+TORCH_THREADS = max(1, (os.cpu_count() or 1) - 1)
+TORCH_INTEROP_THREADS = 1  # openunmix runs one model at a time; no inter-op parallelism to exploit
+WINDOW_SECONDS = 30  # Audio passed to the model per call in chunked mode
+OVERLAP_SECONDS = 2  # Overlap between consecutive windows, crossfaded to hide the seams
+
+PARALLEL_WORKERS = os.cpu_count() or 1  # One single-threaded worker per core
+WORKER_QUEUE = 2  # Windows read ahead per worker, bounds parallel memory use
+
+QUANTIZED_LAYERS = {torch.nn.LSTM, torch.nn.Linear}
+
+TORCHSCRIPT_DIR = Path("models")  # Exported TorchScript target models, one directory per model
+TORCHSCRIPT_CHECK_SECONDS = (3, 7)  # Example lengths the scripted models are checked against eagerly
+
+_separators = {}
+_worker_separator = None
+
+
+def configure_threads(num_threads: int = TORCH_THREADS, interop_threads: int = TORCH_INTEROP_THREADS):
+    """Apply the torch threading policy. Inter-op threads can only be set before torch starts any work."""
+    torch.set_num_threads(num_threads)
+    try:
+        torch.set_num_interop_threads(interop_threads)
+    except RuntimeError:
+        pass  # Already fixed by earlier torch work in this process
+
+
+def crossfade(n: int) -> np.ndarray:
+    """Raised-cosine fade-in of n samples. fade + fade[::-1] == 1, so crossfades keep the level."""
+    return (np.sin(0.5 * np.pi * (np.arange(n) + 0.5) / n) ** 2).astype(np.float32)[:, None]
+
+
+def quantized_path(model_name: str = MODEL_NAME) -> Path:
+    """Where the int8 version of a model is cached, next to the downloaded float weights."""
+    return Path(torch.hub.get_dir()) / "openunmix_quantized" / f"{model_name}_int8_torch{torch.__version__}.pt"
+
+
+def quantize(separator):
+    """Dynamic int8 quantization of a Separator's LSTM and linear layers (CPU only)."""
+    return torch.quantization.quantize_dynamic(separator, QUANTIZED_LAYERS, dtype=torch.qint8)
+
+
+def torchscript_dir(model_name: str = MODEL_NAME) -> Path:
+    return TORCHSCRIPT_DIR / f"{model_name}_torchscript"
+
+
+def torchscript_stamp(model_name: str = MODEL_NAME) -> dict:
+    """What an exported artifact must match to be used: a different model, torch or openunmix makes it stale."""
+    return {"model": model_name, "torch": torch.__version__, "openunmix": metadata.version("openunmix")}
+
+
+def load_torchscript_manifest(model_name: str = MODEL_NAME):
+    """Return the manifest of the exported artifact if it is complete and current, else None."""
+    directory = torchscript_dir(model_name)
+    try:
+        with open(directory / "manifest.json", 'r') as f:
+            manifest = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+    if manifest.get("stamp") != torchscript_stamp(model_name):
+        return None
+    if not all((directory / f"{target}.pt").exists() for target in manifest.get("targets", [])):
+        return None
+    return manifest
+
+
+def export_torchscript(model_name: str = MODEL_NAME) -> Path:
+    """Script and freeze every target model of `model_name` into torchscript_dir(model_name)."""
+    separator = utils.load_separator(model_str_or_path=model_name, device="cpu", pretrained=True)
+    separator.freeze()
+    directory = torchscript_dir(model_name)
+    directory.mkdir(parents=True, exist_ok=True)
+
+    nb_channels = 1 if separator.complexnorm.mono else 2
+    for target, target_model in separator.target_models.items():
+        # Scripted rather than traced: a trace would fix the number of STFT frames of the example.
+        # Sizes computed with numpy (e.g. umxl's max_bin) are not valid TorchScript constants.
+        for module in target_model.modules():
+            for name, value in vars(module).items():
+                if isinstance(value, np.integer):
+                    setattr(module, name, int(value))
+        scripted = torch.jit.freeze(torch.jit.script(target_model.eval()))
+        for seconds in TORCHSCRIPT_CHECK_SECONDS:
+            frames = int(seconds * separator.sample_rate) // separator.stft.n_hop
+            spectrogram = torch.rand(1, nb_channels, target_model.nb_output_bins, frames)
+            with torch.inference_mode():
+                matches = torch.allclose(scripted(spectrogram), target_model(spectrogram), rtol=1e-4, atol=1e-5)
+            if not matches:
+                raise RuntimeError(f"Scripted '{target}' model does not match the original on {seconds} s of audio")
+        tmp_path = directory / f"{target}.pt.tmp"
+        torch.jit.save(scripted, str(tmp_path))
+        os.replace(tmp_path, directory / f"{target}.pt")
+        print(f"Exported '{target}' to {directory / f'{target}.pt'}")
+
+    # The manifest is written last, so an interrupted export is never picked up
+    manifest = {
+        "stamp": torchscript_stamp(model_name),
+        "targets": list(separator.target_models),
+        "niter": separator.niter,
+        "sample_rate": float(separator.sample_rate),
+        "n_fft": separator.stft.n_fft,
+        "n_hop": separator.stft.n_hop,
+        "nb_channels": nb_channels,
+        "wiener_win_len": separator.wiener_win_len
+    }
+    tmp_path = directory / "manifest.json.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(tmp_path, directory / "manifest.json")
+    return directory
+
+
+def _init_worker(separator):
+    """Pool initializer: keep the parent's (already loaded) separator and run torch on one thread."""
+    global _worker_separator
+    configure_threads(1, 1)  # Several OpenMP pools per core would only fight over the CPU
+    _worker_separator = separator
+
+
+def _separate_in_worker(samples, rate, targets):
+    return _worker_separator.separate(samples, rate, targets)
+
+
+class ResidentSeparator:
+    """Keeps one openunmix Separator loaded and runs songs through it."""
+
+    def __init__(self, model: str = MODEL_NAME, device=None, num_threads: int = TORCH_THREADS,
+                 quantized: bool = False, torchscript: bool = True):
+        self.model = model
+        self.quantized = quantized
+        self.torchscript = torchscript and not quantized  # quantize_dynamic needs the Python modules
+        if quantized:
+            device = torch.device("cpu")  # Dynamic quantized kernels only exist for the CPU
+        self.device = device or torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.num_threads = num_threads
+        self.separator = None
+        self._subsets = {}
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Load the weights if they are not loaded yet. Safe to call from several threads."""
+        with self._lock:
+            if self.separator is not None:
+                return self.separator
+            configure_threads(self.num_threads)
+            start = Time.perf_counter()
+            kind = " (int8)" if self.quantized else ""
+            separator = self._load_torchscript() if self.torchscript else None
+            if separator is not None:
+                kind = " (TorchScript)"
+            elif self.quantized:
+                separator = self._load_quantized()
+            else:
+                separator = utils.load_separator(model_str_or_path=self.model, device=self.device, pretrained=True)
+                separator.freeze()
+            separator.to(self.device)
+            self.separator = separator
+            print(f"Loaded openunmix '{self.model}'{kind} in "
+                  f"{Time.perf_counter() - start:.1f} s ({self.num_threads} threads on {self.device})")
+            return separator
+
+    def _load_torchscript(self):
+        """Separator built on the exported TorchScript target models, or None if there is no current export."""
+        manifest = load_torchscript_manifest(self.model)
+        if manifest is None:
+            return None
+        directory = torchscript_dir(self.model)
+        try:
+            target_models = {target: torch.jit.load(str(directory / f"{target}.pt"), map_location=self.device)
+                             for target in manifest["targets"]}
+        except (OSError, RuntimeError) as e:
+            print(f"TorchScript model unusable ({e}); loading the regular weights")
+            return None
+        separator = model.Separator(
+            target_models=target_models,
+            niter=manifest["niter"],
+            sample_rate=manifest["sample_rate"],
+            n_fft=manifest["n_fft"],
+            n_hop=manifest["n_hop"],
+            nb_channels=manifest["nb_channels"],
+            wiener_win_len=manifest["wiener_win_len"]
+        )
+        separator.freeze()
+        return separator
+
+    def _load_quantized(self):
+        """Load the cached int8 separator, or quantize the float one and cache it."""
+        path = quantized_path(self.model)
+        hub_loader = getattr(openunmix, self.model, None)  # Custom model directories are not cached
+        if hub_loader is not None and path.exists():
+            try:
+                # Build the architecture without weights, quantize it, then fill in the cached int8 weights
+                separator = quantize(hub_loader(device="cpu", pretrained=False))
+                separator.load_state_dict(torch.load(path, map_location="cpu", weights_only=False))
+                separator.freeze()
+                return separator
+            except (OSError, RuntimeError) as e:
+                print(f"Quantized model cache unusable ({e}); rebuilding")
+
+        separator = utils.load_separator(model_str_or_path=self.model, device="cpu", pretrained=True)
+        separator.freeze()
+        separator = quantize(separator)
+        separator.freeze()
+        if hub_loader is not None:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_name(path.name + ".tmp")
+            torch.save(separator.state_dict(), tmp_path)
+            os.replace(tmp_path, path)
+            print(f"Cached quantized model in {path}")
+        return separator
+
+    def preload(self) -> threading.Thread:
+        """Load the weights in a background thread so the first song does not wait for them."""
+        thread = threading.Thread(target=self.load, daemon=True)
+        thread.start()
+        return thread
+
+    def target_separator(self, targets=None):
+        """Separator that runs only `targets` (all when None), built on the loaded target models."""
+        separator = self.load()
+        if targets is None or set(targets) >= set(separator.target_models):
+            return separator
+        unknown = set(targets) - set(separator.target_models)
+        if unknown:
+            raise ValueError(f"Unknown targets {sorted(unknown)}; '{self.model}' has {list(separator.target_models)}")
+
+        key = tuple(name for name in separator.target_models if name in targets)
+        with self._lock:
+            if key not in self._subsets:
+                subset = model.Separator(
+                    target_models={name: separator.target_models[name] for name in key},
+                    niter=separator.niter,
+                    residual=True,
+                    sample_rate=float(separator.sample_rate),
+                    n_fft=separator.stft.n_fft,
+                    n_hop=separator.stft.n_hop,
+                    nb_channels=1 if separator.complexnorm.mono else 2,
+                    wiener_win_len=separator.wiener_win_len
+                )
+                subset.freeze()
+                self._subsets[key] = subset.to(self.device)
+            return self._subsets[key]
+
+    def separate(self, samples: np.ndarray, rate: int = FS, targets=None) -> dict:
+        """Separate a (samples, 2) float array into {target: (samples, 2) float32 array}."""
+        separator = self.target_separator(targets)
+        with self._lock, torch.inference_mode():
+            start = Time.perf_counter()
+            estimates = predict.separate(
+                torch.as_tensor(samples).float().T,
+                rate=rate,
+                separator=separator,
+                device=self.device
+            )
+            estimates_numpy = {target: torch.squeeze(estimate, 0).cpu().numpy().T
+                               for target, estimate in estimates.items() if target != "residual"}
+        print(f"Separated {len(samples) / rate:.1f} s of audio in {Time.perf_counter() - start:.1f} s")
+        return estimates_numpy
+
+    def separate_chunked(self, read, n_frames: int, write, rate: int = FS,
+                         window_seconds: float = WINDOW_SECONDS, overlap_seconds: float = OVERLAP_SECONDS,
+                         on_ready=None, workers: int = 1, targets=None):
+        """
+        Separate a long recording in overlapping windows.
+
+        read(start, stop) must return the (stop - start, 2) input frames, and
+        write(target, start, block) is called with consecutive (frames, 2)
+        float32 blocks of each target, in order. Only one window of input and
+        one overlap per target are held at a time. After each window,
+        on_ready(frames) is called with the number of leading frames that are
+        final for every target. With workers > 1, windows are separated in
+        parallel processes (see _window_estimates) and delivered in order.
+        `targets` limits the stems separated, as in separate().
+        """
+        window = int(window_seconds * rate)
+        overlap = int(overlap_seconds * rate)
+        if not 0 < overlap < window:
+            raise ValueError(f"Overlap ({overlap_seconds} s) must be shorter than the window ({window_seconds} s)")
+        fade_in = crossfade(overlap)
+        fade_out = 1 - fade_in
+
+        windows = [(start, min(start + window, n_frames))
+                   for start in range(0, max(n_frames - overlap, 1), window - overlap)]
+        pending = {}
+        for (start, stop), estimates in zip(windows, self._window_estimates(read, windows, rate, workers, targets)):
+            for target, estimate in estimates.items():
+                offset = 0
+                if target in pending:
+                    write(target, start, estimate[:overlap] * fade_in + pending[target] * fade_out)
+                    offset = overlap
+                if stop == n_frames:
+                    write(target, start + offset, estimate[offset:])
+                else:
+                    write(target, start + offset, estimate[offset:-overlap])
+                    pending[target] = estimate[-overlap:]
+            if on_ready is not None:
+                on_ready(n_frames if stop == n_frames else stop - overlap)
+
+    def _window_estimates(self, read, windows, rate, workers, targets=None):
+        """Yield the estimates of each (start, stop) window in order, separated by `workers` processes."""
+        if workers <= 1:
+            for start, stop in windows:
+                yield self.separate(read(start, stop), rate, targets)
+            return
+
+        self.target_separator(targets)  # Load before forking so every worker shares the weights
+        context = multiprocessing.get_context("fork")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                 initializer=_init_worker, initargs=(self,)) as pool:
+            futures = deque()
+            for start, stop in windows:
+                futures.append(pool.submit(_separate_in_worker, read(start, stop), rate, targets))
+                if len(futures) >= WORKER_QUEUE * workers:
+                    yield futures.popleft().result()
+            while futures:
+                yield futures.popleft().result()
+
+
+def get_separator(quantized: bool = False) -> ResidentSeparator:
+    """Return the process-wide (float or int8) separator so the weights are loaded once per session."""
+    if quantized not in _separators:
+        _separators[quantized] = ResidentSeparator(quantized=quantized)
+    return _separators[quantized]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the separation model to TorchScript.")
+    parser.add_argument("command", choices=["export", "show"])
+    parser.add_argument("--model", default=MODEL_NAME)
+    args = parser.parse_args()
+
+    if args.command == "export":
+        export_torchscript(args.model)
+    elif load_torchscript_manifest(args.model) is None:
+        print(f"No current TorchScript export of '{args.model}'; run `python unmix_separator.py export`")
+    else:
+        print(f"'{args.model}' is exported to {torchscript_dir(args.model)} and will be used")
+
+
+if __name__ == "__main__":
+    main()
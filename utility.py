@@ -1,22 +1,27 @@
 import numpy as np
-from scipy.io import loadmat, wavfile
-from scipy.signal import lfilter, resample
-import torch
-from openunmix import predict
+from scipy.io import wavfile
+from scipy.signal import resample
+from unmix_separator import get_separator, WINDOW_SECONDS, OVERLAP_SECONDS
+from hpss_separator import get_hpss_separator
 from IPython.display import Audio, display # type: ignore
 from battery_monitor import get_battery_info, is_charging
 from calibrateUserProfile import apply_hrtf
-from pydub import AudioSegment
+from hrtf_engine import get_engine
+from hrir_bank import itd_scale
+from stem_cache import separation_key, entry_path, lookup, link, adopt, evict
+from stem_store import StemStore, replace_store, STEM_FORMAT, STORE_SUFFIX, STEMS, stems_watermark, stored_targets, stems_tier, stems_format
+from audio_decode import decode_audio, NORMALIZE_HEADROOM_DB
 import os
-import pickle
-import h5py
 import json
 from pathlib import Path
-import h5py
 import gc
 import soundfile as sf
 
 PROFILES_DIR = Path("user_profiles")
+RENDER_MEMORY_BUDGET_MB = 64  # Working memory for chunked HRTF rendering
+RENDER_BYTES_PER_SAMPLE = 64  # Rough working set per sample of a chunk (read, mono, FFT buffers, output)
+PROGRESSIVE_WINDOW_SECONDS = 15  # Segment length of progressive separation; playback can start after the first
+SEPARATION_TIERS = ("fast", "quality")  # HPSS preview (hpss_separator) or the openunmix model
 global volume
 volume = 1
 
@@ -25,24 +30,22 @@ def read_wav_file(filename, fs=16000):
     fs, data = wavfile.read(filename)
     return fs, data
 
+# Non-WAV files are written as 16-bit 44.1 kHz stereo WAV, the format the rest of the app works in
 def convert_to_wav(input_file_path):
     file_name, ext = os.path.splitext(input_file_path)
     ext = ext.lower()
 
-    # Load audio with pydub
+    if ext == ".wav":
+        return input_file_path  # already WAV
+
+    # Decode straight to float32 (see audio_decode)
     try:
-        audio = AudioSegment.from_file(input_file_path)
-    except Exception as e:
+        samples = decode_audio(input_file_path)
+    except RuntimeError as e:
         raise RuntimeError(f"Failed to load audio file: {e}")
 
     wav_file_path = f"{file_name}.wav"
-
-    # Export to WAV format if not already a WAV
-    if ext != ".wav":
-        audio.export(wav_file_path, format="wav")
-    else:
-        wav_file_path = input_file_path  # already WAV
-
+    sf.write(wav_file_path, samples, samplerate=44100, subtype="PCM_16")
     return wav_file_path
 
 # Set Volume
@@ -57,20 +60,8 @@ def get_volume():
 
 # Apply HRTF Function to input signal n, with azimuth(angle) az
 def Apply_HRTF(az, n):
-    data = loadmat(f'HRIRs/Subject_003_{az}_0.mat')
-    hrir_left = data['hrir_left'].flatten()
-    hrir_right = data['hrir_right'].flatten()
-    
-    # Resample HRIRs from 44.1 kHz to 16 kHz
-    #hrir_left_resampled = resample(hrir_left, int(len(hrir_left) * fs / original_fs))
-    #hrir_right_resampled = resample(hrir_right, int(len(hrir_right) * fs / original_fs))
-    
-    # Generate white noise
-    #n = generate_white_noise(duration, fs)
-    
-    y_left = lfilter(hrir_left, 1, n) # Left
-    y_right = lfilter(hrir_right, 1, n) # Right
-    y = np.column_stack((y_left, y_right)).astype(np.float32)
+    # Block FFT convolution, equivalent to lfilter(hrir, 1, n) per ear
+    y = get_engine().render(n, "003", az)
     return y
 
 # Take Stereo input signal and convert to mono signal
@@ -83,46 +74,197 @@ def Stereo_to_mono(signal):
     return 0.5 * (x/peak) # return mono signal
 
 # Separate sources from input signal given file name (Will add more options later)
-def separate_sources(file_name):
-    # Set up Torch
-    use_cuda = torch.cuda.is_available()
-    device = torch.device("cuda" if use_cuda else "cpu")
-
-    # Load the audio file with pydub (supports most formats)
-    audio = AudioSegment.from_file(file_name)
-    audio = audio.normalize()
-
-    # Ensure it's stereo
-    if audio.channels != 2:
-        audio = audio.set_channels(2)
-
-    # Convert to 44100Hz and 16-bit samples
-    audio = audio.set_frame_rate(44100).set_sample_width(2)
-
-    # Get raw data as NumPy array
-    samples = np.array(audio.get_array_of_samples()).reshape((-1, 2))
-    samples = samples.astype(np.int16) / 32768.0  # normalize 16-bit PCM
-
-    # Separate sources
-    estimates = predict.separate(
-        torch.as_tensor(samples).float().T,
-        rate=44100,
-        device=device
-    )
-
-    for target, estimate in estimates.items():
-        print(target)
-        audio_out = estimate.detach().cpu().numpy()[0]
-        display(Audio(audio_out, rate=44100))
+# workers > 1 separates overlapping segments in parallel processes (see unmix_separator)
+# targets limits separation to those stems, e.g. ["vocals", "other"]
+# quantized uses the int8 model: faster on the CPU, slightly lower quality
+# The separator uses the TorchScript export when present (`python unmix_separator.py export`)
+# tier="fast" uses the HPSS preview separator instead of the model (quantized is then ignored)
+def separate_sources(file_name, workers=1, targets=None, quantized=False, tier="quality"):
+    # Decode to normalized float32 stereo at 44.1 kHz in one pass (see audio_decode)
+    samples = decode_audio(file_name, normalize=True)
+
+    # Separate sources with the resident model (weights stay loaded between songs)
+    separator = tier_separator(tier, quantized)
+    if workers > 1:
+        estimates_numpy = {}
+        def write(target, start, block):
+            if target not in estimates_numpy:
+                estimates_numpy[target] = np.zeros((len(samples), 2), dtype=np.float32)
+            estimates_numpy[target][start:start + len(block)] = block
+        separator.separate_chunked(lambda start, stop: samples[start:stop], len(samples), write,
+                                   workers=workers, targets=targets)
+    else:
+        estimates_numpy = separator.separate(samples, targets=targets)
 
-    # Convert to dictionary of NumPy arrays
-    estimates_numpy = {}
-    for target, estimate in estimates.items():
-        estimates_numpy[target] = torch.squeeze(estimate).detach().cpu().numpy().T
-        sf.write(f"Spatial/{target}_output.wav", estimates_numpy[target], samplerate=44100)
+    for target, estimate in estimates_numpy.items():
+        print(target)
+        display(Audio(estimate.T, rate=44100))
+        sf.write(f"Spatial/{target}_output.wav", estimate, samplerate=44100)
 
     return estimates_numpy
 
+def cache_key(file_name, tier="quality", quantized=False, window=None, stem_format=STEM_FORMAT):
+    """
+    stem_cache key of a song's stems from the separator of this tier.
+
+    The stems also depend on window, the (window_seconds, overlap_seconds) of
+    chunked separation or None for a whole-track pass, and on the stem_format
+    they are stored in. The targets are left out: an entry holding some of the
+    stems is completed with ensure_stems rather than separated again.
+    """
+    separator = tier_separator(tier, quantized)
+    return separation_key(file_name, {"model": separator.model, "quantized": separator.quantized,
+                                      "window": list(window) if window is not None else None,
+                                      "format": stem_format})
+
+def tier_separator(tier="quality", quantized=False):
+    """Separator for a separation tier: the HPSS preview for "fast", the openunmix model for "quality"."""
+    if tier not in SEPARATION_TIERS:
+        raise ValueError(f"Unknown separation tier '{tier}', expected one of {SEPARATION_TIERS}")
+    return get_hpss_separator() if tier == "fast" else get_separator(quantized)
+
+class AudioFrames:
+    """
+    Random access to the normalized 44.1 kHz stereo frames of an audio file.
+    mono_peak is the peak of L + R after normalization.
+
+    Files soundfile can read at 44.1 kHz are read from disk a window at a time
+    (after one pass to find the peak); anything else is decoded whole by
+    audio_decode, as in separate_sources.
+    """
+
+    def __init__(self, file_name, read_size=1 << 18):
+        self.file = None
+        self.samples = None
+        try:
+            self.file = sf.SoundFile(file_name)
+        except (RuntimeError, TypeError):
+            pass
+        if self.file is not None and self.file.samplerate == 44100:
+            peak = mono_peak = 0.0
+            for block in self.file.blocks(blocksize=read_size, dtype='float32', always_2d=True):
+                peak = max(peak, float(np.max(np.abs(block), initial=0.0)))
+                mono = block[:, 0] + block[:, 1] if block.shape[1] > 1 else 2 * block[:, 0]
+                mono_peak = max(mono_peak, float(np.max(np.abs(mono), initial=0.0)))
+            self.frames = self.file.frames
+            self.gain = 10 ** (-NORMALIZE_HEADROOM_DB / 20) / (peak or 1.0)
+            self.mono_peak = mono_peak * self.gain
+            return
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+        self.samples = decode_audio(file_name, normalize=True)
+        self.frames = len(self.samples)
+        self.mono_peak = float(np.max(np.abs(self.samples[:, 0] + self.samples[:, 1]), initial=0.0))
+
+    def read(self, start, stop):
+        """(stop - start, 2) float32 frames in [-1, 1]."""
+        if self.samples is not None:
+            return self.samples[start:stop]
+        self.file.seek(start)
+        block = self.file.read(stop - start, dtype='float32', always_2d=True)
+        if block.shape[1] == 1:
+            block = np.repeat(block, 2, axis=1)
+        return block[:, :2] * self.gain
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+        self.samples = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def separate_to_file(file_name, output_filepath, window_seconds=WINDOW_SECONDS, overlap_seconds=OVERLAP_SECONDS,
+                     progressive=False, workers=1, targets=None, append=False, quantized=False, tier="quality",
+                     stem_format=STEM_FORMAT):
+    """
+    Chunked version of separate_sources + saving the stems.
+
+    The track is separated in overlapping windows and each target is written
+    to its stem file in the stem store as soon as a window is finished, so
+    peak memory is set by window_seconds instead of the track length. The
+    store is written under a temporary name and renamed when complete.
+
+    With progressive=True the store is written in place instead, marked
+    incomplete, and its "ready_frames" watermark is advanced after every
+    window so the spatial player can start on the part that is done (see
+    stem_store.stems_watermark).
+
+    `targets` limits the stems separated. With append=True they are added to
+    an existing store (see ensure_stems); each new stem is marked incomplete
+    until it is fully written.
+
+    The store's "tier" attribute records which separator made it (see
+    tier_separator), so fast preview stems can be told apart and replaced.
+    Stems are stored as float32 or in a compact `stem_format` ("int16",
+    "float16"; see stem_store).
+    """
+    tmp_filepath = output_filepath if progressive or append else output_filepath + ".part"
+    with AudioFrames(file_name) as audio:
+        n = audio.frames
+        peaks = {}
+        writers = {}
+        if append:
+            store = StemStore(tmp_filepath)
+            if store.attrs.get("frames", n) != n:
+                raise ValueError(f"{file_name} has {n} frames but {output_filepath} was made from {store.attrs['frames']}")
+        else:
+            # mix_mono_peak scales the stems until their own peaks are known
+            store = StemStore.create(tmp_filepath, source=file_name, tier=tier, complete=False, frames=n,
+                                     ready_frames=0, mix_mono_peak=audio.mono_peak)
+
+        def write(target, start, block):
+            if target not in writers:
+                writers[target] = store.writer(target, n, stem_format)  # Replaces a stem left by an interrupted append
+                peaks[target] = 0.0
+            writers[target].write(block)  # Blocks arrive in order, so start is where the writer is
+            peaks[target] = max(peaks[target], float(np.max(np.abs(block[:, 0] + block[:, 1]), initial=0.0)))
+
+        def advance(ready):
+            if not append:
+                # Compact writers hold back the last partial block until it is complete
+                store.update(ready_frames=min([ready] + [writer.frames for writer in writers.values()]))
+            if progressive:
+                print(f"Separated up to {ready / 44100:.1f} s of {n / 44100:.1f} s")
+
+        print(f"Chunked separation of {n / 44100:.1f} s in {window_seconds} s windows")
+        tier_separator(tier, quantized).separate_chunked(audio.read, n, write, window_seconds=window_seconds,
+                                                         overlap_seconds=overlap_seconds, on_ready=advance,
+                                                         workers=workers, targets=targets)
+        for target, peak in peaks.items():
+            writers[target].close(mono_peak=peak)
+        store.update(complete=True)
+    if tmp_filepath != output_filepath:
+        replace_store(tmp_filepath, output_filepath)
+
+def ensure_stems(stems_directory, stem_names, workers=1):
+    """
+    Separate any of stem_names that the stem store does not have yet, from the
+    song it was made from, with the tier and stem format the store was made
+    with. Returns False if they are missing and cannot be made.
+    """
+    missing = [name for name in stem_names if name not in stored_targets(stems_directory)]
+    if not missing:
+        return True
+    source = StemStore(stems_directory).attrs.get("source")
+    if not source or not os.path.exists(source):
+        print(f"Cannot separate {missing}: source song of {stems_directory} not found")
+        return False
+    print(f"Separating missing stems {missing}")
+    separate_to_file(source, stems_directory, targets=missing, append=True, workers=workers,
+                     tier=stems_tier(stems_directory), stem_format=stems_format(stems_directory))
+    return True
+
+def spatial_stems_path(file_name):
+    """Stem store (a link into stem_cache) that run_spatial_audio makes for a file in Music/."""
+    name_only, _ = os.path.splitext(os.path.relpath(file_name, "Music"))
+    return "Spatial/" + name_only + STORE_SUFFIX
+
 # Sum the signals of the modified stems
 def summed_signal(modified_vocals, modified_bass, modified_other, modified_drums):
     global volume
@@ -149,32 +291,6 @@ def Spacial_Audio_Separation(file_name):
     summed_song = summed_signal(modified_vocals, modified_bass, modified_other, modified_drums)
     return summed_song
 
-def run_spatial_audio_old(file_name):
-    print("Starting process")
-    only_file_name = os.path.relpath(file_name, "Music")
-    print(file_name)
-    name_only, ext = os.path.splitext(only_file_name)
-    print(name_only)
-    output_filepath = "Spatial/" + name_only + ".h5"
-    print(output_filepath)
-    if os.path.exists(output_filepath):
-        print("Separated HDF5 file found. Skipping processing.")
-       
-    else:
-        print("No HDF5 file: Starting Seperation")
-        
-        estimates_numpy = separate_sources(file_name)
-
-        print("Trying to save HDF5 file")
-        # Save stems to pickle file
-        with h5py.File(output_filepath, "w") as f:
-            f.create_dataset("vocals", data=estimates_numpy['vocals'], compression="gzip")
-            f.create_dataset("drums", data=estimates_numpy['drums'], compression="gzip")
-            f.create_dataset("bass", data=estimates_numpy['bass'], compression="gzip")
-            f.create_dataset("other", data=estimates_numpy['other'], compression="gzip")
-
-    return "Song successfully converted."
-
 def apply_bulk_hrtf_old(stems_directory, Loaded_Profile):
     
     try:
@@ -210,18 +326,19 @@ def apply_bulk_hrtf_old(stems_directory, Loaded_Profile):
     print("Apply HRTFs")
     angles = profile_data["stem_directions"]
     test_subject = profile_data['hrtf_subject']
+    head_scale = itd_scale(profile_data['effective_radius'], test_subject)
     print("Create Stems dict")
     spacial_stems = {'vocals' : 0, 'drums' : 0, 'bass' : 0, 'other' : 0}
 
 
-    with h5py.File(stems_directory, "r") as f:
-        for stem_name in ["vocals", "drums", "bass", "other"]:
-            print(f"Processing {stem_name}")
-            stem = f[stem_name][:]
-            angle = angles[stem_name]
-            processed = apply_hrtf(stem, angle, test_subject)
-            spacial_stems[stem_name] = processed
-            del stem
+    stems = StemStore(stems_directory)
+    for stem_name in ["vocals", "drums", "bass", "other"]:
+        print(f"Processing {stem_name}")
+        stem = stems.read(stem_name)
+        angle = angles[stem_name]
+        processed = apply_hrtf(stem, angle, test_subject, head_scale)
+        spacial_stems[stem_name] = processed
+        del stem
 
 
     print("Finished HRTFS")
@@ -229,186 +346,75 @@ def apply_bulk_hrtf_old(stems_directory, Loaded_Profile):
     return spacial_stems
 
 
-def save_stems_to_pkl_v1(estimates_numpy, song_name, metadata_file="Spatial/metadata.pkl", data_file=None):
-    """Save audio stems (numpy arrays) into a pickle file with metadata indexing for efficient retrieval."""
-    data_file = data_file or f"Spatial/{song_name}.pkl"
-    metadata = {}  # Dictionary to store offset indexes for quick lookup
-
-    with open(data_file, "wb") as f:
-        for stem_name, stem_data in estimates_numpy.items():
-            offset = f.tell()  # Store byte position before writing
-            
-            pickle.dump(stem_data, f)  # Write stem data
-            
-            metadata[stem_name] = {
-                "offset": offset,  # Store byte position
-                "shape": stem_data.shape,  # Store array shape (dimensions)
-                "dtype": str(stem_data.dtype),  # Store data type
-                "song": song_name  # Track which song this belongs to
-            }
-
-    # Save metadata separately for lookup optimization
-    with open(metadata_file, "wb") as meta_f:
-        pickle.dump(metadata, meta_f)
-
-    print(f"✅ Saved stems for {song_name} with metadata indexing.")
-
-    # Example: Store processed stems (NumPy arrays)
-    estimates_numpy = {
-        "vocals": np.random.rand(44100, 2),  # Stereo vocals
-        "drums": np.random.rand(44100, 2),   # Stereo drums
-        "bass": np.random.rand(44100, 1),    # Mono bass
-        "other": np.random.rand(44100, 2)    # Stereo other sounds
-    }
-
-    save_stems_to_pkl_v2(estimates_numpy, "example_song")
-
-
-def save_stems_to_pkl_v2(estimates_numpy, song_name):
-    """Save audio stems (numpy arrays) into a pickle file with metadata indexing in the correct directory."""
-    
-    song_dir = f"Spatial/{song_name}/"
-    os.makedirs(song_dir, exist_ok=True)  # Ensure the directory exists
-    
-    metadata_file = f"{song_dir}metadata.pkl"
-    data_file = f"{song_dir}stems.pkl"
-    metadata = {}  # Dictionary to store offset indexes for quick lookup
-
-    with open(data_file, "wb") as f:
-        for stem_name, stem_data in estimates_numpy.items():
-            offset = f.tell()  # Store byte position before writing
-            
-            pickle.dump(stem_data, f)  # Write stem data
-            
-            metadata[stem_name] = {
-                "offset": offset,  # Byte position in file
-                "shape": stem_data.shape,  # Array dimensions
-                "dtype": str(stem_data.dtype),  # Data type
-                "song": song_name  # Track song name
-            }
-
-    # Save metadata separately in the same folder
-    with open(metadata_file, "wb") as meta_f:
-        pickle.dump(metadata, meta_f)
-
-    print(f"✅ Saved stems and metadata for {song_name} in {song_dir}")
-
-def load_specific_stem(stem_name, song_name, metadata_file="Spatial/metadata.pkl", data_file=None):
-    """Load only a specific stem using metadata indexing to avoid unnecessary memory usage."""
-    data_file = data_file or f"Spatial/{song_name}.pkl"
-
-    # Load metadata first
-    with open(metadata_file, "rb") as meta_f:
-        metadata = pickle.load(meta_f)
-
-    if stem_name not in metadata:
-        raise ValueError(f"❌ Stem '{stem_name}' not found for {song_name}.")
-
-    offset = metadata[stem_name]["offset"]  # Retrieve byte position of the requested stem
-
-    # Open the main data file and seek to correct position
-    with open(data_file, "rb") as f:
-        f.seek(offset)  # Jump directly to stored byte position
-        stem_data = pickle.load(f)  # Deserialize only this portion
-
-    return stem_data
-
-    # Example: Load "drums" from the pickle file without full deserialization
-    drums_data = load_specific_stem("drums", "example_song")
-    print("✅ Loaded Drums Shape:", drums_data.shape)
-
-
-def apply_bulk_hrtf_new(song_name, Loaded_Profile, metadata_file="Spatial/metadata.pkl"):
-    """Apply HRTF processing to individual stems, loading dynamically from PKL files."""
-    
-    try:
-        with open(f"{PROFILES_DIR}/{Loaded_Profile}", "r") as f:
-            profile_data = json.load(f)
-
-        if not all(k in profile_data for k in ["hrtf_subject", "effective_radius"]):
-            print(f"❌ Invalid profile: {Loaded_Profile}. Missing required fields.")
-            return None
-
-        print(f"\n✅ Selected profile: {Loaded_Profile}")
-        print(f"   🎧 HRTF Subject: {profile_data['hrtf_subject']} ({'Female' if profile_data['hrtf_subject'] == '019' else 'Male'})")
-        print(f"   📏 Head Width: {profile_data.get('head_width', 15.2):.2f} cm")
-        print(f"   📏 Head Length: {profile_data.get('head_length', 19.0):.2f} cm")
-        print(f"   🎯 Effective Radius: {profile_data['effective_radius']:.2f} cm")
-
-    except json.JSONDecodeError:
-        print(f"❌ Error: {Loaded_Profile} is not a valid JSON file.")
-        return None
-
-    # Stem directions (angles for spatial audio)
-    angles = profile_data.get("stem_directions", {"bass": 0, "vocals": 0, "drums": 0, "other": 0})
-    test_subject = profile_data["hrtf_subject"]
-
-    print("\n🚀 Applying HRTF processing for each stem...")
-
-    spacial_stems = {}
-    for stem in ["vocals", "drums", "bass", "other"]:
-        print(f"🔄 Processing {stem}...")
-        audio_data = load_specific_stem(stem, song_name)  # Load only this stem
-        spacial_stems[stem] = apply_hrtf(audio_data, angles[stem], test_subject)
-
-    print("✅ Finished HRTF processing!")
-
-    return spacial_stems
-
-def run_spatial_audio_new(file_name):
-    """Process audio file, separate sources, and store stems with metadata indexing."""
-    
-    print("Starting process")
-    only_file_name = os.path.relpath(file_name, "Music")
-    name_only, _ = os.path.splitext(only_file_name)
-    
-    metadata_file = f"Spatial/{name_only}_metadata.pkl"
-    data_file = f"Spatial/{name_only}.pkl"
-
-    # If the pickle file exists, load indexed metadata instead of the full file
-    if os.path.exists(metadata_file):
-        print("✅ Metadata found, attempting to load individual stems when needed.")
-        with open(metadata_file, 'rb') as f:
-            metadata = pickle.load(f)
-    else:
-        print("🆕 No pickle metadata file found: Starting Separation")
-
-        estimates_numpy = separate_sources(file_name)  # Extract stems
-
-        print("🔄 Saving stems with metadata indexing...")
-        save_stems_to_pkl_v2(estimates_numpy, name_only, metadata_file, data_file)
+def load_specific_stem(stem_name, song_name):
+    """One stem of a separated song, mapped from its stem store rather than read into memory."""
+    return StemStore(f"Spatial/{song_name}{STORE_SUFFIX}").read(stem_name)
 
-    return f"🎵 Song '{name_only}' successfully converted."
 
-
-
-def run_spatial_audio(file_name):
+# targets (default: all stems) limits the stems separated; missing ones can be added later with ensure_stems
+# Stem stores are kept in a content-addressed cache (see stem_cache) and linked from spatial_stems_path(file_name),
+# so renamed or duplicated songs reuse them and changed songs are separated again.
+# tier="quality" over fast preview stems keeps the preview linked until the quality stems are finished
+# stem_format stores the stems as float32 or in a compact format (see stem_store)
+def run_spatial_audio(file_name, chunked=False, progressive=False, workers=1, targets=None, quantized=False,
+                      tier="quality", stem_format=STEM_FORMAT):
     print("Starting process")
-    only_file_name = os.path.relpath(file_name, "Music")
     print(file_name)
-    name_only, ext = os.path.splitext(only_file_name)
-    print(name_only)
-    output_filepath = "Spatial/" + name_only + ".h5"
+    output_filepath = spatial_stems_path(file_name)
     print(output_filepath)
-    if os.path.exists(output_filepath):
-        print("Separated HDF5 file found. Skipping processing.")
-       
+    if (os.path.isdir(output_filepath) and not os.path.islink(output_filepath)
+            and stems_watermark(output_filepath)[1]):
+        # Stems from before the cache: file them under the separation that made them
+        adopt(output_filepath, cache_key(file_name, stems_tier(output_filepath),
+                                         stem_format=stems_format(output_filepath)))
+
+    preview = (os.path.exists(output_filepath) and stems_watermark(output_filepath)[1]
+               and stems_tier(output_filepath) == "fast")
+    if progressive and not preview:
+        window = (PROGRESSIVE_WINDOW_SECONDS, OVERLAP_SECONDS)
+    elif progressive or chunked:
+        window = (WINDOW_SECONDS, OVERLAP_SECONDS)
     else:
-        print("No HDF5 file: Starting Seperation")
-        
-        estimates_numpy = separate_sources(file_name)
-
-        print("Trying to save HDF5 file")
-        # Save stems to pickle file
-        with h5py.File(output_filepath, "w") as f:
-            f.create_dataset("vocals", data=estimates_numpy['vocals'], compression="gzip")
-            f.create_dataset("drums", data=estimates_numpy['drums'], compression="gzip")
-            f.create_dataset("bass", data=estimates_numpy['bass'], compression="gzip")
-            f.create_dataset("other", data=estimates_numpy['other'], compression="gzip")
+        window = None
+    key = cache_key(file_name, tier, quantized, window, stem_format)
+    cache_filepath = str(entry_path(key))
+    if lookup(key) is not None:
+        print("Separated stems found. Skipping processing.")
+        link(output_filepath, key)
+        ensure_stems(output_filepath, targets or STEMS, workers=workers)
+        return "Song successfully converted."
+
+    if progressive and not preview:
+        print("Starting progressive Seperation")
+        link(output_filepath, key)  # Playback follows the new file from its first segment
+        separate_to_file(file_name, cache_filepath, window_seconds=PROGRESSIVE_WINDOW_SECONDS, progressive=True,
+                         workers=workers, targets=targets, quantized=quantized, tier=tier, stem_format=stem_format)
+
+    elif progressive or chunked:
+        if preview:
+            print("Fast preview stems found: keeping them until quality separation finishes")
+        print("No stems: Starting chunked Seperation")
+        separate_to_file(file_name, cache_filepath, workers=workers, targets=targets, quantized=quantized,
+                         tier=tier, stem_format=stem_format)
 
+    else:
+        print("No stems: Starting Seperation")
+        
+        estimates_numpy = separate_sources(file_name, workers=workers, targets=targets, quantized=quantized,
+                                           tier=tier)
+
+        print("Saving stems")
+        store = StemStore.create(cache_filepath + ".part", source=file_name, tier=tier)
+        for stem_name, stem in estimates_numpy.items():
+            # Peak used by Stereo_to_mono, so the streaming renderer can scale blocks without a full read
+            store.write(stem_name, stem, stem_format, mono_peak=float(np.max(np.abs(stem[:, 0] + stem[:, 1]))))
+        replace_store(cache_filepath + ".part", cache_filepath)
+
+    link(output_filepath, key)
+    evict(keep={key})
     return "Song successfully converted."
 
-def apply_bulk_hrtf(stems_directory, Loaded_Profile):
+def apply_bulk_hrtf(stems_directory, Loaded_Profile, chunked=False, block_size=None, memory_budget_mb=RENDER_MEMORY_BUDGET_MB):
     
     try:
         with open(f"{PROFILES_DIR}/{Loaded_Profile}", 'r') as f:
@@ -440,33 +446,45 @@ def apply_bulk_hrtf(stems_directory, Loaded_Profile):
     if "stem_directions" not in profile_data:
         profile_data["stem_directions"] = {"bass": 0, "vocals": 0, "drums": 0, "other": 0}
     
+    if not ensure_stems(stems_directory, STEMS):
+        return
+
     print("Apply HRTFs")
     angles = profile_data["stem_directions"]
     test_subject = profile_data['hrtf_subject']
+    head_scale = itd_scale(profile_data['effective_radius'], test_subject)
+
+    if chunked:
+        block_size = block_size or block_size_for_budget(memory_budget_mb)
+        render_stems_chunked(stems_directory, stems_directory + ".tmp", ["vocals", "drums", "bass", "other"], angles, test_subject, block_size,
+                             head_scale)
+        print("Finished HRTFS")
+        return
 
     import psutil
-    with h5py.File(stems_directory, "r") as f_in, h5py.File(stems_directory + ".tmp", "w") as f_out:
-        for stem_name in ["vocals", "drums", "bass", "other"]:
-            print(f"Processing {stem_name}")
-            print(f"Memory used: {psutil.Process().memory_info().rss / 1e6:.2f} MB")
-            stem = f_in[stem_name][:]  # Load to RAM
-            
-            print(f"Memory used: {psutil.Process().memory_info().rss / 1e6:.2f} MB")
-            angle = angles[stem_name]
-            stem = Stereo_to_mono(stem)
-            processed = apply_hrtf(stem, angle, test_subject)
-            sf.write(f"Spatial/hrtf_{stem_name}_output.wav", processed, samplerate=44100)
-            print(f"Memory used: {psutil.Process().memory_info().rss / 1e6:.2f} MB")
-            
-            f_out.create_dataset(f"hrtf_{stem_name}", data=processed, compression="gzip")
-            
-            # Free memory
-            del stem, processed
-            gc.collect()
+    stems = StemStore(stems_directory)
+    out = StemStore.create(stems_directory + ".tmp")
+    for stem_name in ["vocals", "drums", "bass", "other"]:
+        print(f"Processing {stem_name}")
+        print(f"Memory used: {psutil.Process().memory_info().rss / 1e6:.2f} MB")
+        stem = stems.read(stem_name)  # Mapped; paged in as it is read
+        
+        print(f"Memory used: {psutil.Process().memory_info().rss / 1e6:.2f} MB")
+        angle = angles[stem_name]
+        stem = Stereo_to_mono(stem)
+        processed = apply_hrtf(stem, angle, test_subject, head_scale)
+        sf.write(f"Spatial/hrtf_{stem_name}_output.wav", processed, samplerate=44100)
+        print(f"Memory used: {psutil.Process().memory_info().rss / 1e6:.2f} MB")
+        
+        out.write(f"hrtf_{stem_name}", processed)
+        
+        # Free memory
+        del stem, processed
+        gc.collect()
 
     print("Finished HRTFS")
 
-def apply_selected_hrtf(stems_directory, Loaded_Profile, selected_stems):
+def apply_selected_hrtf(stems_directory, Loaded_Profile, selected_stems, chunked=False, block_size=None, memory_budget_mb=RENDER_MEMORY_BUDGET_MB):
     
     if selected_stems == []:
         return None
@@ -500,41 +518,90 @@ def apply_selected_hrtf(stems_directory, Loaded_Profile, selected_stems):
     if "stem_directions" not in profile_data:
         profile_data["stem_directions"] = {"bass": 0, "vocals": 0, "drums": 0, "other": 0}
     
+    if not ensure_stems(stems_directory, selected_stems):
+        return None
+
     print("Apply HRTFs")
     angles = profile_data["stem_directions"]
     test_subject = profile_data['hrtf_subject']
+    head_scale = itd_scale(profile_data['effective_radius'], test_subject)
+
+    if chunked:
+        block_size = block_size or block_size_for_budget(memory_budget_mb)
+        render_stems_chunked(stems_directory, stems_directory + ".specific.tmp", selected_stems, angles, test_subject, block_size,
+                             head_scale)
+        print("Finished HRTFS")
+        return
 
     import psutil
-    with h5py.File(stems_directory, "r") as f_in, h5py.File(stems_directory + ".specific.tmp", "w") as f_out:
-        for stem_name in selected_stems:
-            print(f"Processing {stem_name}")
-            print(f"Memory used: {psutil.Process().memory_info().rss / 1e6:.2f} MB")
-            stem = f_in[stem_name][:]  # Load to RAM
-            
-            print(f"Memory used: {psutil.Process().memory_info().rss / 1e6:.2f} MB")
-            angle = angles[stem_name]
-            stem = Stereo_to_mono(stem)
-            processed = apply_hrtf(stem, angle, test_subject)
-            sf.write(f"Spatial/hrtf_{stem_name}_output.wav", processed, samplerate=44100)
-            print(f"Memory used: {psutil.Process().memory_info().rss / 1e6:.2f} MB")
-            
-            f_out.create_dataset(f"hrtf_{stem_name}", data=processed, compression="gzip")
-            
-            # Free memory
-            del stem, processed
-            gc.collect()
+    stems = StemStore(stems_directory)
+    out = StemStore.create(stems_directory + ".specific.tmp")
+    for stem_name in selected_stems:
+        print(f"Processing {stem_name}")
+        print(f"Memory used: {psutil.Process().memory_info().rss / 1e6:.2f} MB")
+        stem = stems.read(stem_name)  # Mapped; paged in as it is read
+        
+        print(f"Memory used: {psutil.Process().memory_info().rss / 1e6:.2f} MB")
+        angle = angles[stem_name]
+        stem = Stereo_to_mono(stem)
+        processed = apply_hrtf(stem, angle, test_subject, head_scale)
+        sf.write(f"Spatial/hrtf_{stem_name}_output.wav", processed, samplerate=44100)
+        print(f"Memory used: {psutil.Process().memory_info().rss / 1e6:.2f} MB")
+        
+        out.write(f"hrtf_{stem_name}", processed)
+        
+        # Free memory
+        del stem, processed
+        gc.collect()
 
     print("Finished HRTFS")
 
 
 
+def block_size_for_budget(memory_budget_mb):
+    """Largest power-of-two chunk (in samples) whose working set fits in the memory budget."""
+    samples = int(memory_budget_mb * 1e6 / RENDER_BYTES_PER_SAMPLE)
+    return max(4096, 1 << (samples.bit_length() - 1))
+
+def render_stems_chunked(stems_directory, output_filepath, stem_names, angles, test_subject, block_size, head_scale=1.0):
+    """
+    Render stems to hrtf_<stem> stems of the store at output_filepath one chunk at a time.
+
+    Each stem is read, converted to mono, convolved and written in chunks of
+    block_size samples, with the convolution tail carried between chunks, so
+    peak memory depends on block_size and not on the length of the track.
+    head_scale personalizes the interaural delay (see hrir_bank.itd_scale).
+    """
+    import psutil
+    engine = get_engine()
+    print(f"Chunked render with {block_size} samples per block")
+    stems = StemStore(stems_directory)
+    out_store = StemStore.create(output_filepath)
+    for stem_name in stem_names:
+        print(f"Processing {stem_name}")
+        reader = stems.reader(stem_name)
+        n = len(reader)
+        scale = 0.5 / (stems.mono_peak(stem_name) or 1.0)  # Same scaling as Stereo_to_mono
+        spec = engine.hrtf_spectrum(test_subject, angles[stem_name], head_scale)
+        out = out_store.writer(f"hrtf_{stem_name}", n)
+
+        tail = None
+        with sf.SoundFile(f"Spatial/hrtf_{stem_name}_output.wav", "w", samplerate=44100, channels=2) as wav:
+            for start in range(0, n, block_size):
+                mono = reader.read_mono(start, start + block_size, scale)
+                processed, tail = engine.convolve(mono, spec, tail)
+                out.write(processed.T)
+                wav.write(processed.T)
+        out.close()
+        print(f"Memory used: {psutil.Process().memory_info().rss / 1e6:.2f} MB")
+
 def summed_signal_from_file(stems_directory):
     
     summed_song = 0
-    with h5py.File(stems_directory + ".tmp", 'r') as f:
-        for stem_name in ["hrtf_vocals", "hrtf_drums", "hrtf_bass", "hrtf_other"]:
-            #spacial_stems[stem_name] = f[stem_name][:]
-            summed_song += f[stem_name][:]
+    stems = StemStore(stems_directory + ".tmp")
+    for stem_name in ["hrtf_vocals", "hrtf_drums", "hrtf_bass", "hrtf_other"]:
+        #spacial_stems[stem_name] = f[stem_name][:]
+        summed_song += stems.read(stem_name)
 
     summed_song /= 4
 
@@ -544,12 +611,35 @@ def summed_signal_from_file(stems_directory):
 def summed_stems_from_file(stems_directory, selected_stems):
     
     summed_song = 0
-    with h5py.File(stems_directory + ".specific.tmp", 'r') as f:
-        for stem_name in selected_stems:
-            #spacial_stems[stem_name] = f[stem_name][:]
-            summed_song += f[f"hrtf_{stem_name}"][:]
+    stems = StemStore(stems_directory + ".specific.tmp")
+    for stem_name in selected_stems:
+        #spacial_stems[stem_name] = f[stem_name][:]
+        summed_song += stems.read(f"hrtf_{stem_name}")
 
     summed_song /= len(selected_stems)
 
     #summed_song = (spacial_stems["hrtf_vocals"] + spacial_stems["hrtf_drums"] + spacial_stems["hrtf_bass"] + spacial_stems["hrtf_other"])/4
-    return summed_song
\ No newline at end of file
+    return summed_song
+
+def load_profile_data(Loaded_Profile):
+    """Load a profile JSON, falling back to the default profile if it is missing fields or invalid."""
+    default_profile = {
+        "hrtf_subject": "003",
+        "effective_radius": 8.5,
+        "head_width": 15.2,
+        "head_length": 19.0,
+        "stem_directions": {"bass": 0, "vocals": 0, "drums": 0, "other": 0}
+    }
+    try:
+        with open(f"{PROFILES_DIR}/{Loaded_Profile}", 'r') as f:
+            profile_data = json.load(f)
+        if not all(k in profile_data for k in ['hrtf_subject', 'effective_radius']):
+            print(f"Invalid profile: {Loaded_Profile} Missing required fields.")
+            profile_data = default_profile
+    except json.JSONDecodeError:
+        print(f"Error: {Loaded_Profile} is not a valid JSON file.")
+        profile_data = default_profile
+
+    if "stem_directions" not in profile_data:
+        profile_data["stem_directions"] = dict(default_profile["stem_directions"])
+    return profile_data